@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+# Copyright (C) Cezar Burlacu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Benchmark of the conversion stages on a synthetic CubeMX database
+"""
+
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import cube
+import chibi
+
+MCU_NS = 'http://mcd.rou.st.com/modules.php?name=mcu'
+PORTS = 'ABCDEFGHIJK'
+
+# (family, GPIO IP version)
+FAMILIES = [
+    ('STM32F4', 'STM32F417_gpio_v1_0'),
+    ('STM32F7', 'STM32F767_gpio_v1_0'),
+    ('STM32L4', 'STM32L4S_gpio_v1_0'),
+    ('STM32F0', 'STM32F091_gpio_v1_0'),
+]
+
+
+def getPinNames(pins):
+    names = []
+    for i in range(min(pins, len(PORTS) * 16)):
+        names.append("P%s%d" % (PORTS[i // 16], i % 16))
+    # a few pins with the CubeMX suffixes
+    if len(names) > 0:
+        names[0] += '-WKUP'
+    if len(names) > 30:
+        names[30] += '-OSC32_IN'
+    return names
+
+
+def writeFile(fileName, lines):
+    with open(fileName, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def generateDB(folder, mcus=10, pins=100, signals=8):
+    """
+        Write db/mcu/families.xml, db/mcu/<mcu>.xml and db/mcu/IP/GPIO-<version>_Modes.xml
+        and returns the list of the generated part numbers
+    """
+    mcuFolder = os.path.join(folder, 'db', 'mcu')
+    ipFolder = os.path.join(mcuFolder, 'IP')
+    if not os.path.isdir(ipFolder):
+        os.makedirs(ipFolder)
+    pinNames = getPinNames(pins)
+    families = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+                '<Families xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">']
+    partNumbers = []
+    for familyIdx, (family, gpioVersion) in enumerate(FAMILIES):
+        families.append('  <Family Name="%s">' % family)
+        families.append('    <SubFamily Name="%s Series">' % family)
+        for idx in range(familyIdx, mcus, len(FAMILIES)):
+            refName = "%sB%03dTx" % (family, idx)
+            name = "%sB%03d(E-G)Tx" % (family, idx)
+            partNumbers.append(refName)
+            families.append('      <Mcu Name="%s" PackageName="LQFP%d" RefName="%s" RPN="%s">'
+                            % (name, pins, refName, refName[:-2]))
+            families.append('        <Core>ARM Cortex-M4</Core>')
+            families.append('        <Frequency>168</Frequency>')
+            families.append('      </Mcu>')
+
+            lines = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+                     '<Mcu xmlns="%s" Family="%s" RefName="%s">' % (MCU_NS, family, name),
+                     '  <Core>ARM Cortex-M4</Core>',
+                     '  <IP InstanceName="RCC" Name="RCC" Version="%s_rcc_v1_0"/>' % family,
+                     '  <IP InstanceName="GPIO" Name="GPIO" Version="%s"/>' % gpioVersion]
+            for pinIdx, pinName in enumerate(pinNames):
+                lines.append('  <Pin Name="%s" Position="%d" Type="I/O">' % (pinName, pinIdx + 1))
+                for sig in range(signals):
+                    lines.append('    <Signal Name="USART%d_TX"/>' % (sig + 1))
+                lines.append('    <Signal Name="GPIO_Output"/>')
+                lines.append('  </Pin>')
+            lines.append('  <Pin Name="VDD" Position="%d" Type="Power"/>' % (len(pinNames) + 1))
+            lines.append('</Mcu>')
+            writeFile(os.path.join(mcuFolder, name + '.xml'), lines)
+        families.append('    </SubFamily>')
+        families.append('  </Family>')
+
+        lines = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+                 '<IP xmlns="%s" DBVersion="V4.0" IPType="peripheral" Name="GPIO" Version="%s">'
+                 % (MCU_NS, gpioVersion)]
+        for refName, value in [('GPIO_Speed', 'GPIO_SPEED_FREQ_LOW'), ('GPIO_PuPd', 'GPIO_NOPULL'),
+                               ('PinState', 'GPIO_PIN_RESET'), ('GPIO_ModeDefaultOutputPP', 'GPIO_MODE_OUTPUT_PP')]:
+            lines.append('  <RefParameter Comment="%s" DefaultValue="%s" Name="%s" Type="list"/>'
+                         % (refName, value, refName))
+        for pinName in pinNames:
+            lines.append('  <GPIO_Pin PortName="P%s" Name="%s">' % (pinName[1], pinName))
+            lines.append('    <SpecificParameter Name="GPIO_Pu"><PossibleValue>GPIO_PULLUP</PossibleValue></SpecificParameter>')
+            for sig in range(signals):
+                lines.append('    <PinSignal Name="USART%d_TX">' % (sig + 1))
+                lines.append('      <SpecificParameter Name="GPIO_AF">')
+                lines.append('        <PossibleValue>GPIO_AF%d_USART%d</PossibleValue>' % (sig % 16, sig + 1))
+                lines.append('      </SpecificParameter>')
+                lines.append('    </PinSignal>')
+            lines.append('  </GPIO_Pin>')
+        lines.append('</IP>')
+        writeFile(os.path.join(ipFolder, 'GPIO-%s_Modes.xml' % gpioVersion), lines)
+
+    families.append('</Families>')
+    writeFile(os.path.join(mcuFolder, 'families.xml'), families)
+    return partNumbers
+
+
+def generateIOC(fileName, partNo, pins=100, signals=8):
+    lines = ['#MicroXplorer Configuration settings - do not modify',
+             'Mcu.Family=%s' % partNo[:7],
+             'Mcu.UserName=%s' % partNo,
+             'PCC.Vdd=3.3',
+             'RCC.HSE_VALUE=8000000',
+             'RCC.LSE_VALUE=32768']
+    for idx, pinName in enumerate(getPinNames(pins)):
+        pin = pinName.split('-')[0]
+        kind = idx % 4
+        if kind == 0:
+            lines += ['%s.Signal=GPIO_Output' % pin, '%s.GPIO_Label=LED %d' % (pin, idx),
+                      '%s.PinState=GPIO_PIN_SET' % pin, '%s.Locked=true' % pin]
+        elif kind == 1 and signals > 0:
+            lines += ['%s.Signal=USART%d_TX' % (pin, idx % signals + 1), '%s.Mode=Asynchronous' % pin,
+                      '%s.GPIO_Speed=GPIO_SPEED_FREQ_VERY_HIGH' % pin]
+        elif kind == 2:
+            lines += ['%s.Signal=ADC1_IN%d' % (pin, idx % 16)]
+        else:
+            lines += ['%s.Signal=GPIO_Input' % pin, '%s.GPIO_PuPd=GPIO_PULLUP' % pin]
+    writeFile(fileName, lines)
+
+
+# a board file like the ones the users merge with
+def generateChibi(fileName, pins=100):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<board xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+             ' xsi:noNamespaceSchemaLocation="http://www.chibios.org/xml/schema/boards/stm32f4xx_board.xsd">',
+             '  <configuration_settings>',
+             '    <templates_path>resources/gencfg/processors/boards/stm32f4xx/templates</templates_path>',
+             '    <output_path>..</output_path>',
+             '    <hal_version>3.0.x</hal_version>',
+             '  </configuration_settings>',
+             '  <board_name>Benchmark board</board_name>',
+             '  <board_id>BENCH_BOARD</board_id>',
+             '  <board_functions></board_functions>',
+             '  <subtype>STM32F407xx</subtype>',
+             '  <clocks HSEFrequency="8000000" HSEBypass="false" LSEFrequency="32768" LSEBypass="false" VDD="330"/>',
+             '  <ports>']
+    for port in PORTS[:(min(pins, len(PORTS) * 16) + 15) // 16]:
+        lines.append('    <GPIO%s>' % port)
+        for pin in range(16):
+            lines.append('      <pin%d ID="BENCH_%s%d" Type="PushPull" Level="High" Speed="Maximum"'
+                         ' Resistor="Floating" Mode="Input" Alternate="0"/>' % (pin, port, pin))
+        lines.append('    </GPIO%s>' % port)
+    lines += ['  </ports>', '</board>']
+    writeFile(fileName, lines)
+
+
+def timed(results, stage, func, *args):
+    start = time.perf_counter()
+    # the messages are not part of the measurement
+    with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(devNull):
+        retVal = func(*args)
+    results.setdefault(stage, []).append(time.perf_counter() - start)
+    return retVal
+
+
+def runConversion(results, db, iocFile, chibiIn, chibiOut, getMCUStage):
+    properties = timed(results, 'loadIOC', cube.loadIOC, iocFile)
+    partNo = properties['Mcu.UserName']
+    mcu = timed(results, getMCUStage, db.getMCU, partNo)
+    mcu.CubeFile = iocFile
+    timed(results, 'updateProperties', mcu.updateProperties, properties)
+    timed(results, 'generateConfig' if chibiIn is None else 'generateConfig (merge)',
+          chibi.generateConfig, mcu, chibiIn, chibiOut)
+
+
+def summary(times):
+    times = sorted(times)
+    return {
+        'runs': len(times),
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+        'total': sum(times),
+    }
+
+
+def runBenchmark(folder, mcus, pins, signals, repeat):
+    partNumbers = generateDB(folder, mcus, pins, signals)
+    chibiIn = os.path.join(folder, 'board.chcfg')
+    chibiOut = os.path.join(folder, 'out.chcfg')
+    generateChibi(chibiIn, pins)
+    iocFiles = []
+    for partNo in partNumbers:
+        iocFile = os.path.join(folder, partNo + '.ioc')
+        generateIOC(iocFile, partNo, pins, signals)
+        iocFiles.append(iocFile)
+
+    results = {}
+    for run in range(repeat):
+        # cold: nothing cached, on disk or in memory
+        db = cube.CubeDB(folder, tempfile.mkdtemp(dir=folder))
+        for iocFile in iocFiles:
+            runConversion(results, db, iocFile, None, chibiOut, 'getMCU (cold)')
+        # warm: from the disk cache - the models kept in memory are forgotten
+        db.clear()
+        for iocFile in iocFiles:
+            runConversion(results, db, iocFile, chibiIn, chibiOut, 'getMCU (disk cache)')
+        # hot: from the memory
+        for iocFile in iocFiles:
+            runConversion(results, db, iocFile, None, chibiOut, 'getMCU (memory)')
+        shutil.rmtree(db.cachePath)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the conversion on a synthetic CubeMX database")
+    parser.add_argument("--mcus", type=int, default=20, help="The number of MCUs in the database")
+    parser.add_argument("--pins", type=int, default=144, help="The number of GPIO pins of each MCU")
+    parser.add_argument("--signals", type=int, default=8, help="The number of alternate functions of each pin")
+    parser.add_argument("--repeat", type=int, default=3, help="How many times the conversions are repeated")
+    parser.add_argument("--output", default=None, help="The JSON report file (default: stdout)")
+    parser.add_argument("--keep", default=None, help="Generate the database in this folder and keep it")
+    args = parser.parse_args()
+
+    folder = args.keep or tempfile.mkdtemp(prefix='cube2chibi-bench-')
+    try:
+        results = runBenchmark(folder, args.mcus, args.pins, args.signals, args.repeat)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'mcus': args.mcus, 'pins': args.pins, 'signals': args.signals, 'repeat': args.repeat},
+        'stages': dict((stage, summary(times)) for stage, times in results.items()),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+# Copyright (C) Cezar Burlacu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Persistent cache for the data extracted from the CubeMX database.
+    The cache folder can be shared by more processes: the entries are written aside and
+    renamed, and an entry is built by only one process while the others wait for it
+"""
+
+import os
+import pickle
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no locking - the processes may build the same entry, it is still written atomically
+
+CACHE_NAME = 'cube2chibi'
+FORMAT = 3  # changed when the cached data is changed
+
+# least recently used entries are removed above the max size: the data extracted
+# from the databases and, separately, the conversion results
+MAX_SIZE = 256 * 1024 * 1024
+RESULTS_FOLDER = 'results'
+MAX_RESULTS_SIZE = 64 * 1024 * 1024
+# the entries are removed down to this part of the max size, not scanned again at each store
+LOW_WATER = 0.75
+
+_sizes = {}  # folder -> the size of its entries, counted by the last scan and the stores since
+_sizesLock = threading.Lock()
+
+
+# all the functions use the folder given, the user cache folder if None
+def getCacheDir(folder=None):
+    if folder is not None:
+        return folder
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, CACHE_NAME)
+
+
+def getKey(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+# a file is considered unchanged as long as its size and mtime are the same
+def fileSignature(fileName):
+    try:
+        st = os.stat(fileName)
+    except (OSError, IOError):
+        return None
+    return st.st_size, int(st.st_mtime * 1000000)
+
+
+def _entryPath(name, folder):
+    return os.path.join(getCacheDir(folder), name + '.pickle')
+
+
+def _resultPath(key, folder):
+    return os.path.join(getCacheDir(folder), RESULTS_FOLDER, key)
+
+
+# the name of an entry may contain a folder (e.g. a namespace per database: <namespace>/<entry>)
+def load(name, signature, folder=None):
+    if signature is None:
+        return None
+    fileName = _entryPath(name, folder)
+    try:
+        with open(fileName, 'rb') as f:
+            entry = pickle.load(f)
+        if entry.get('format') == FORMAT and entry['signature'] == signature:
+            # mtime is the last use - for the eviction
+            os.utime(fileName, None)
+            return entry['data']
+    except Exception:
+        pass
+    return None
+
+
+def store(name, signature, data, folder=None):
+    if signature is None:
+        return False
+    size = _write_(_entryPath(name, folder), {'format': FORMAT, 'signature': signature, 'data': data})
+    if size is None:
+        return False
+    cacheDir = getCacheDir(folder)
+    _evict_(cacheDir, MAX_SIZE, size, os.path.join(cacheDir, RESULTS_FOLDER))
+    return True
+
+
+@contextlib.contextmanager
+def lock(name, folder=None):
+    """
+        Only one process (or thread) holds the lock of an entry, the others wait for it:
+        the entry is loaded again after the lock is taken, it may be already built
+    """
+    fileName = _entryPath(name, folder) + '.lock'
+    f = None
+    try:
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        f = open(fileName, 'a')
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    except (OSError, IOError) as ex:
+        print("Failed to lock the cache entry %s - %s" % (fileName, ex))
+    try:
+        yield
+    finally:
+        # closing the file releases the lock
+        if f is not None:
+            f.close()
+
+
+# the cached entry, built (and stored) only if not found - only once for all the processes
+def loadOrBuild(name, signature, build, folder=None):
+    data = load(name, signature, folder)
+    if data is None:
+        with lock(name, folder):
+            data = load(name, signature, folder)
+            if data is None:
+                data = build()
+                if data is not None:
+                    store(name, signature, data, folder)
+    return data
+
+
+# the size written, None if failed
+def _write_(fileName, data):
+    folder = os.path.dirname(fileName)
+    tmpName = None
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        # write aside and rename: readers never see a partial entry
+        fd, tmpName = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.replace(tmpName, fileName)
+        return size
+    except Exception as ex:
+        print("Failed to update the cache %s - %s" % (fileName, ex))
+        if tmpName is not None and os.path.exists(tmpName):
+            os.remove(tmpName)
+    return None
+
+
+def loadResult(key, folder=None):
+    fileName = _resultPath(key, folder)
+    try:
+        with open(fileName, 'rb') as f:
+            result = pickle.load(f)
+        # mtime is the last use - for the eviction
+        os.utime(fileName, None)
+        return result
+    except Exception:
+        return None
+
+
+# without loading it, e.g. to skip the work needed only by a conversion
+def hasResult(key, folder=None):
+    return os.path.isfile(_resultPath(key, folder))
+
+
+def storeResult(key, result, folder=None):
+    size = _write_(_resultPath(key, folder), result)
+    if size is not None:
+        _evict_(os.path.join(getCacheDir(folder), RESULTS_FOLDER), MAX_RESULTS_SIZE, size)
+
+
+# removes the least recently used entries of the folder (and its sub folders, but
+# the excluded one) when above the max size. The folder is scanned only once, then when
+# the size counted (the entries added by this process) is above the max size; a scan
+# counts the entries of the other processes too
+def _evict_(folder, maxSize, added, exclude=None):
+    with _sizesLock:
+        total = _sizes.get(folder)
+        if total is not None:
+            total = _sizes[folder] = total + added
+            if total <= maxSize:
+                return
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) != exclude]
+        for name in files:
+            if name.endswith('.tmp') or name.endswith('.lock'):
+                continue
+            fileName = os.path.join(root, name)
+            try:
+                st = os.stat(fileName)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fileName))
+            total += st.st_size
+    if total > maxSize:
+        # the lock files are kept: a process may hold the lock of the entry removed
+        for mtime, size, fileName in sorted(entries):
+            if total <= maxSize * LOW_WATER:
+                break
+            try:
+                os.remove(fileName)
+                total -= size
+            except OSError:
+                continue
+    with _sizesLock:
+        _sizes[folder] = total
+
+
+def clearResults(folder=None):
+    folder = os.path.join(getCacheDir(folder), RESULTS_FOLDER)
+    if os.path.isdir(folder):
+        print("Removing the cached results from %s" % folder)
+        shutil.rmtree(folder, ignore_errors=True)
+    with _sizesLock:
+        _sizes.pop(folder, None)
@@ -18,6 +18,11 @@
     All ChibiOS related stuff
 """
 
+import os
+import re
+import copy
+import instrument
+import xmlbackend
 from utils import *
 
 
@@ -147,7 +152,60 @@ def getValue(dictionary, key, newValue, default=""):
         return default
 
 
-def updatePinElem(pinElem, pinObj):
+class BoardIndex:
+    """
+        The elements of an existing board file, indexed once: the first element of
+        each tag (document order) and the pins by (port, pin) - e.g. ('GPIOA', 'pin0')
+    """
+    sections = {}
+    pins = {}
+
+    def __init__(self, root):
+        self.sections = {}
+        self.pins = {}
+        if root is None:
+            return
+        count = 0
+        for elem in root.iter():
+            count += 1
+            if isinstance(elem.tag, str):
+                self.sections.setdefault(localTag(elem), elem)
+        instrument.visit(count)
+        for portsElem in root.iter('{*}' + ct['ports']):
+            for portElem in portsElem:
+                for pinElem in portElem:
+                    if isinstance(portElem.tag, str) and isinstance(pinElem.tag, str):
+                        self.pins.setdefault((localTag(portElem), localTag(pinElem)), pinElem)
+
+    def getOrCreateSection(self, tag):
+        elem = self.sections.get(tag)
+        return elem if elem is not None else et.Element(tag)
+
+    def getOrCreatePin(self, port, pin):
+        elem = self.pins.get((port, pin))
+        return elem if elem is not None else et.Element(pin)
+
+
+class UnusedPin:
+    """
+        A pin that is not available on the MCU package: only default values
+    """
+    ID = None
+    Type = None
+    Level = None
+    Speed = None
+    Resistor = None
+    Mode = None
+    Alternate = None
+    AnalogSwitch = None
+    parent = None
+
+
+def localTag(elem):
+    return et.QName(elem).localname
+
+
+def updatePinElem(pinElem, pinObj, family=None):
     if pinElem is not None and pinObj is not None:
 
         pinElem.attrib[ct['pId']] = make_id(getValue(pinElem.attrib, ct['pId'], pinObj.ID))
@@ -159,7 +217,7 @@ def updatePinElem(pinElem, pinObj):
         pinElem.attrib[ct['pAlt']] = getValue(pinElem.attrib, ct['pAlt'], pinObj.Alternate)
 
         try:
-            family = getFamily(pinObj.parent)
+            family = family or getFamily(pinObj.parent)
             if chGpioVersion[family] == '3':
                 pinElem.attrib[ct['gpSw']] = getValue(pinElem.attrib, ct['gpSw'], pinObj.AnalogSwitch)
                 pinElem.attrib[ct['gpLck']] = getValue(pinElem.attrib, ct['gpLck'], pinObj.AnalogSwitch)
@@ -167,14 +225,33 @@ def updatePinElem(pinElem, pinObj):
             pass
 
 
-def generateConfig(micro, boardIn, boardOut):
+def updateClocksElem(elem, micro, family):
+    # HSE
+    elem.attrib[ct['hse']] = getValue(elem.attrib, ct['hse'], micro.HSEClock)
+    elem.attrib[ct['hseBy']] = getValue(elem.attrib, ct['hseBy'], micro.HSEClock)
+    # LSE
+    elem.attrib[ct['lse']] = getValue(elem.attrib, ct['lse'], micro.LSEClock)
+    elem.attrib[ct['lseBy']] = getValue(elem.attrib, ct['lseBy'], micro.LSEClock)
+    if not isEmpty(chLseDriveDefault[family]):
+        elem.attrib[ct['lseDrive']] = chLseDriveDefault[family]
+    # VDD voltage
+    elem.attrib[ct['vdd']] = getValue(elem.attrib, ct['vdd'], micro.VDD)
+
+
+# the board of the MCU, merged with the initial board boardIn (a file or the root element, optional).
+# The board is written in boardOut, if not None; returns the root element of the board
+def generateConfig(micro, boardIn, boardOut=None):
     print("Start generatig chibi file for %s" % micro)
-    parser = et.XMLParser()
     family = getFamily(micro)
     oldRoot, ns = None, ''
 
-    if boardIn is not None:
-        oldRoot, ns = getRoot(boardIn, parser)
+    with instrument.stage('loadBoard'):
+        if isinstance(boardIn, str):
+            oldRoot, ns = getRoot(boardIn, xmlbackend.LXML)
+        elif boardIn is not None:
+            # the elements of the initial board are moved in the new one
+            oldRoot, ns = copy.deepcopy(boardIn), getNs(boardIn.tag)
+        old = BoardIndex(oldRoot)
 
     boardNs = 'http://www.w3.org/2001/XMLSchema-instance'
 
@@ -191,53 +268,43 @@ def generateConfig(micro, boardIn, boardOut):
     # configuration settings - don't bother if this doesn't exists
     # just insert empty ones - basically it extract the nodes from old xml
     # and add them to the new one
-    confElem = getOrCreateElem(oldRoot, ct['conf'], ct['conf'], ns)
+    confElem = old.getOrCreateSection(ct['conf'])
     elem = getOrCreateElem(confElem, ct['template'], ct['template'], ns)
     elem.text = chTemplates[family]
     confElem.append(elem)
 
-    elem = getOrCreateElem(oldRoot, ct['out'], ct['out'], ns)
+    elem = old.getOrCreateSection(ct['out'])
     elem.text = getValue(None, None, elem.text, '..')
     confElem.append(elem)
 
-    elem = getOrCreateElem(oldRoot, ct['hal'], ct['hal'], ns)
+    elem = old.getOrCreateSection(ct['hal'])
     elem.text = getValue(None, None, elem.text, '3.0.x')
     confElem.append(elem)
     root.append(confElem)
 
     # board name
-    elem = getOrCreateElem(oldRoot, ct['name'], ct['name'], ns)
+    elem = old.getOrCreateSection(ct['name'])
     elem.text = getValue(None, None, elem.text, 'Custom board: {0}'.format(micro.partNumber))
     root.append(elem)
 
     # board id
-    elem = getOrCreateElem(oldRoot, ct['board_id'], ct['board_id'], ns)
+    elem = old.getOrCreateSection(ct['board_id'])
     elem.text = getValue(None, None, elem.text, 'CUSTOM_BOARD')
     root.append(elem)
 
     # board functions
-    elem = getOrCreateElem(oldRoot, ct['func'], ct['func'], ns)
+    elem = old.getOrCreateSection(ct['func'])
     elem.text = getValue(None, None, elem.text, '')
     root.append(elem)
 
     # subtype
-    elem = getOrCreateElem(oldRoot, ct['subtype'], ct['subtype'], ns)
+    elem = old.getOrCreateSection(ct['subtype'])
     elem.text = getValue(None, None, elem.text, "SUBTYPE_" + family)
     root.append(elem)
 
     # clock
-    elem = getOrCreateElem(oldRoot, ct['clock'], ct['clock'], ns)
-    # HSE
-    elem.attrib[ct['hse']] = getValue(elem.attrib, ct['hse'], micro.HSEClock)
-    elem.attrib[ct['hseBy']] = getValue(elem.attrib, ct['hseBy'], micro.HSEClock)
-    # LSE
-    elem.attrib[ct['lse']] = getValue(elem.attrib, ct['lse'], micro.LSEClock)
-    elem.attrib[ct['lseBy']] = getValue(elem.attrib, ct['lseBy'], micro.LSEClock)
-    if not isEmpty(chLseDriveDefault[family]):
-        elem.attrib[ct['lseDrive']] = chLseDriveDefault[family]
-    # VDD voltage
-    elem.attrib[ct['vdd']] = getValue(elem.attrib, ct['vdd'], micro.VDD)
-
+    elem = old.getOrCreateSection(ct['clock'])
+    updateClocksElem(elem, micro, family)
     root.append(elem)
 
     # iterate all possible ports
@@ -249,19 +316,367 @@ def generateConfig(micro, boardIn, boardOut):
         portsElem.append(portElem)
         # for pin in sorted(micro.ports[port]):
         for pin in range(0, 16):
-            pinName = getPinName(port, pin)
-            if pinName in micro.pins:
-                pinObj = micro.pins[pinName]
+            pinObj = micro.getPin(port, pin) or UnusedPin
             chibiPin = "pin{0}".format(pin)
-            pinElem = getOrCreateElem(oldRoot, "{0}/{1}/{2}".format(ct['ports'], chibiPort, chibiPin), chibiPin, ns)
-            updatePinElem(pinElem, pinObj)
+            pinElem = old.getOrCreatePin(chibiPort, chibiPin)
+            updatePinElem(pinElem, pinObj, family)
             portElem.append(pinElem)
 
-    print("Writing the results in '%s'" % boardOut)
-
+    if boardOut is not None:
+        print("Writing the results in '%s'" % boardOut)
+        try:
+            with instrument.stage('write'):
+                tree.write(boardOut, encoding='utf-8', xml_declaration=True, pretty_print=True)
+        except Exception as ex:
+            print("Failed to save the result:", ex)
+
+    return root
+
+
+# the content of a board (.chcfg), as written by generateConfig
+def serializeBoard(root):
+    return et.tostring(root.getroottree(), encoding='UTF-8', xml_declaration=True, pretty_print=True)
+
+
+# the markup of a xml document: comments, processing instructions, CDATA, DOCTYPE and
+# the start tags (name, attributes) - in the same order as the elements
+_xmlMarkup = re.compile(r'<!--.*?-->|<\?.*?\?>|<!\[CDATA\[.*?\]\]>|<!DOCTYPE[^>]*>|'
+                        r'<([^\s/>!?]+)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*/?>', re.DOTALL)
+
+
+# replaces the attributes of elem, the attributes still used keep their position
+def replaceAttributes(elem, newElem):
+    for key in list(elem.attrib):
+        if key not in newElem.attrib:
+            del elem.attrib[key]
+    for key, value in newElem.attrib.items():
+        elem.set(key, value)
+
+
+# the attributes of elem as written in a start tag: ' name="value" ...'
+def formatAttributes(elem):
+    text = et.tostring(et.Element('a', dict(elem.attrib)), encoding='unicode')
+    return text[2:-2]
+
+
+# the text of the document with only the attributes of the changed elements replaced
+def patchAttributes(text, root, changed):
+    elements = list(root.iter(tag=et.Element))
+    parts = []
+    last = 0
+    count = 0
+    for m in _xmlMarkup.finditer(text):
+        if m.group(1) is None:
+            continue
+        if count >= len(elements) or m.group(1).rpartition(':')[2] != localTag(elements[count]):
+            return None
+        if elements[count] in changed:
+            parts.append(text[last:m.start(2)])
+            parts.append(formatAttributes(elements[count]))
+            last = m.end(2)
+        count += 1
+    parts.append(text[last:])
+    return ''.join(parts)
+
+
+# updates only the given pins [(port, pin number)] and, if clocks is True, the clocks
+# of an existing board (boardOut); only the attributes of these elements are rewritten,
+# the rest of the file is not touched. The values are the ones of a full conversion (generateConfig).
+# Returns the root of the updated board, None if the board cannot be updated
+def patchConfig(micro, pins, clocks, boardIn, boardOut):
+    print("Updating %d pins of '%s' for %s" % (len(pins), boardOut, micro))
+    family = getFamily(micro)
     try:
-        tree.write(boardOut, encoding='utf-8', xml_declaration=True, pretty_print=True)
-    except Exception as ex:
-        print("Failed to save the result:", ex)
+        with open(boardOut, 'rb') as f:
+            data = f.read()
+        text = data.decode('utf-8')
+        root = et.fromstring(data)
+    except (OSError, IOError, ValueError, et.XMLSyntaxError) as ex:
+        print("Failed to load %s - %s" % (boardOut, ex))
+        return None
+    current = BoardIndex(root)
+    changed = set()
+    with instrument.stage('loadBoard'):
+        old = BoardIndex(getRoot(boardIn, xmlbackend.LXML)[0] if boardIn is not None else None)
+
+    if clocks:
+        elem = current.sections.get(ct['clock'])
+        if elem is None:
+            return None
+        newElem = old.getOrCreateSection(ct['clock'])
+        newElem = et.Element(newElem.tag, dict(newElem.attrib))
+        updateClocksElem(newElem, micro, family)
+        replaceAttributes(elem, newElem)
+        changed.add(elem)
+
+    for port, pin in pins:
+        chibiPort = "GPIO{0}".format(port)
+        chibiPin = "pin{0}".format(pin)
+        elem = current.pins.get((chibiPort, chibiPin))
+        if elem is None:
+            print("%s.%s was not found in '%s'" % (chibiPort, chibiPin, boardOut))
+            return None
+        newElem = old.getOrCreatePin(chibiPort, chibiPin)
+        newElem = et.Element(newElem.tag, dict(newElem.attrib))
+        updatePinElem(newElem, micro.getPin(port, pin) or UnusedPin, family)
+        replaceAttributes(elem, newElem)
+        changed.add(elem)
+
+    text = patchAttributes(text, root, changed)
+    if text is None:
+        print("Failed to update '%s'" % boardOut)
+        return None
+    print("Writing the results in '%s'" % boardOut)
+    with instrument.stage('write'):
+        with open(boardOut, 'wb') as f:
+            f.write(text.encode('utf-8'))
+    return root
+
+
+# chibi pin value -> register bits, the bits per pin for each register
+_moder = {'Input': 0, 'Output': 1, 'Alternate': 2, 'Analog': 3}
+_otyper = {'PushPull': 0, 'OpenDrain': 1}
+_ospeedr = {'Minimum': 0, 'Low': 1, 'High': 2, 'Maximum': 3}
+_pupdr = {'Floating': 0, 'PullUp': 1, 'PullDown': 2}
+_odr = {'Low': 0, 'High': 1}
+_enabled = {'Disabled': 0, 'Enabled': 1}
+_alternate = dict((str(af), af) for af in range(0, 16))
+
+# register -> (pin attribute, chibi value -> bits, bits per pin), the AF registers are split in AFRL / AFRH
+gpioRegisters = [
+    ('MODER', ct['pMode'], _moder, 2),
+    ('OTYPER', ct['pType'], _otyper, 1),
+    ('OSPEEDR', ct['pSpeed'], _ospeedr, 2),
+    ('PUPDR', ct['pRes'], _pupdr, 2),
+    ('ODR', ct['pLevel'], _odr, 1),
+    ('AFR', ct['pAlt'], _alternate, 4),
+]
+gpioV3Registers = [
+    ('ASCR', ct['gpSw'], _enabled, 1),
+    ('LOCKR', ct['gpLck'], _enabled, 1),
+]
+
+BOARD_H_HEADER = """/*
+    ChibiOS - Copyright (C) 2006..2016 Giovanni Di Sirio
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+*/
+
+/*
+ * This file has been automatically generated using cube2chibi.py.
+ */
+"""
 
 
+def packBits(fields, width):
+    value = 0
+    for n, field in enumerate(fields):
+        value |= field << (n * width)
+    return value
+
+
+def getPinValue(pinElem, attribute, values, name):
+    value = pinElem.get(attribute) if pinElem is not None else None
+    value = chdef.get(attribute) if isEmpty(value) else value.strip()
+    if value not in values:
+        raise ValueError("%s: invalid %s '%s'" % (name, attribute, value))
+    return values[value]
+
+
+# the register values of a port: all the 16 pins of each register are packed at once
+def getPortRegisters(portName, pinElems, gpioVersion):
+    registers = gpioRegisters + (gpioV3Registers if gpioVersion == '3' else [])
+    values = {}
+    for register, attribute, bits, width in registers:
+        fields = [getPinValue(pinElems[pin], attribute, bits, '%s pin%d' % (portName, pin)) for pin in range(0, 16)]
+        if register == 'AFR':
+            values['AFRL'] = packBits(fields[:8], width)
+            values['AFRH'] = packBits(fields[8:], width)
+        else:
+            values[register] = packBits(fields, width)
+    return values
+
+
+def getPinComment(pinElem):
+    mode = pinElem.get(ct['pMode'], chdef['Mode']) if pinElem is not None else chdef['Mode']
+    if mode == 'Alternate':
+        return 'alternate %s' % pinElem.get(ct['pAlt'], chdef['Alternate'])
+    elif mode == 'Analog':
+        return 'analog'
+    elif mode == 'Output':
+        return 'output %s %s' % (pinElem.get(ct['pType'], chdef['Type']).lower(),
+                                 pinElem.get(ct['pSpeed'], chdef['Speed']).lower())
+    resistor = pinElem.get(ct['pRes'], chdef['Resistor']) if pinElem is not None else chdef['Resistor']
+    return 'input %s' % resistor.lower()
+
+
+def getSectionText(root, tag, default=''):
+    elem = root.find('{*}' + tag)
+    return elem.text.strip() if elem is not None and not isEmpty(elem.text) else default
+
+
+def define(name, value):
+    return "#define %-32s%s" % (name, value)
+
+
+# the root of a board (.chcfg) content
+def parseBoard(data):
+    return et.fromstring(data)
+
+
+# the family of the templates used by the board
+def getTemplatesFamily(root):
+    confElem = root.find('{*}' + ct['conf'])
+    path = getSectionText(confElem if confElem is not None else root, ct['template'])
+    for family in sorted(chTemplates):
+        if chTemplates[family] == path:
+            return family
+    return chdef['Family']
+
+
+# all the ports GPIOA..GPIOK as [(port name, [16 pin elements or None])]: PALConfig has a field
+# per port the MCU may have, the ports missing from the board (.chcfg) get the default values
+def getBoardPorts(root):
+    ports = [('GPIO' + port, [None] * 16) for port in PORTS]
+    byName = dict(ports)
+    portsElem = root.find('{*}' + ct['ports'])
+    for portElem in (portsElem if portsElem is not None else []):
+        if not isinstance(portElem.tag, str):
+            continue
+        pinElems = byName.get(localTag(portElem))
+        if pinElems is None:
+            print("Unknown port %s - not in board.h / board.c" % localTag(portElem))
+            continue
+        for pinElem in portElem:
+            if isinstance(pinElem.tag, str) and localTag(pinElem).startswith('pin'):
+                pin = int(localTag(pinElem)[3:])
+                if 0 <= pin < 16:
+                    pinElems[pin] = pinElem
+    return ports
+
+
+def generateBoardHeader(root, family, ports):
+    gpioVersion = chGpioVersion[family]
+    clocks = root.find('{*}' + ct['clock'])
+    clocks = clocks if clocks is not None else et.Element(ct['clock'])
+    lines = [BOARD_H_HEADER, "#ifndef BOARD_H", "#define BOARD_H", "",
+             "/*", " * Setup for %s board." % getSectionText(root, ct['name']), " */", "",
+             "/*", " * Board identifier.", " */",
+             "#define BOARD_%s" % getSectionText(root, ct['board_id'], 'CUSTOM_BOARD'),
+             define('BOARD_NAME', '"%s"' % getSectionText(root, ct['name'])), "",
+             "/*", " * Board oscillators-related settings.", " */",
+             "#if !defined(STM32_LSECLK)",
+             define('STM32_LSECLK', '%sU' % clocks.get(ct['lse'], chdef['LSEFrequency'])),
+             "#endif", ""]
+    lseDrive = clocks.get(ct['lseDrive'])
+    if not isEmpty(lseDrive):
+        lines += [define('STM32_LSEDRV', '(%sU << 3U)' % lseDrive.split()[0]), ""]
+    if clocks.get(ct['lseBy']) == 'true':
+        lines += [define('STM32_LSE_BYPASS', ''), ""]
+    lines += ["#if !defined(STM32_HSECLK)",
+              define('STM32_HSECLK', '%sU' % clocks.get(ct['hse'], chdef['HSEFrequency'])),
+              "#endif", ""]
+    if clocks.get(ct['hseBy']) == 'true':
+        lines += [define('STM32_HSE_BYPASS', ''), ""]
+    lines += ["/*", " * Board voltages.", " * Required for performance limits calculation.", " */",
+              define('STM32_VDD', '%sU' % clocks.get(ct['vdd'], chdef['VDD'])), "",
+              "/*", " * MCU type as defined in the ST header.", " */",
+              "#define %s" % getSectionText(root, ct['subtype'], 'SUBTYPE_' + family), ""]
+
+    pinNames = {}
+    lines += ["/*", " * IO pins assignments.", " */"]
+    for portName, pinElems in ports:
+        for pin, pinElem in enumerate(pinElems):
+            pinId = pinElem.get(ct['pId']) if pinElem is not None else None
+            pinNames[(portName, pin)] = "%s_%s" % (portName, pinId if not isEmpty(pinId) else 'PIN%d' % pin)
+            lines.append(define(pinNames[(portName, pin)], '%dU' % pin))
+        lines.append("")
+    lines += ["/*", " * IO lines assignments.", " */"]
+    for portName, pinElems in ports:
+        for pin, pinElem in enumerate(pinElems):
+            pinId = pinElem.get(ct['pId']) if pinElem is not None else None
+            if not isEmpty(pinId):
+                lines.append(define('LINE_' + pinId, 'PAL_LINE(%s, %dU)' % (portName, pin)))
+    lines += ["", "/*", " * I/O ports initial setup, this configuration is established soon after reset",
+              " * in the initialization code.", " * Please refer to the STM32 Reference Manual for details.", " */", ""]
+
+    for portName, pinElems in ports:
+        registers = getPortRegisters(portName, pinElems, gpioVersion)
+        lines += ["/*", " * %s setup:" % portName, " *"]
+        for pin, pinElem in enumerate(pinElems):
+            name = "P%s%d" % (portName[-1], pin)
+            pinId = pinElem.get(ct['pId']) if pinElem is not None else None
+            lines.append(" * %-4s - %-25s (%s)." % (name, pinId if not isEmpty(pinId) else 'PIN%d' % pin,
+                                                    getPinComment(pinElem)))
+        lines.append(" */")
+        for register, attribute, bits, width in gpioRegisters + (gpioV3Registers if gpioVersion == '3' else []):
+            for name in (['AFRL', 'AFRH'] if register == 'AFR' else [register]):
+                lines.append(define('VAL_%s_%s' % (portName, name), '0x%08XU' % registers[name]))
+        lines.append("")
+
+    lines += ["#if !defined(_FROM_ASM_)", "#ifdef __cplusplus", 'extern "C" {', "#endif",
+              "  void boardInit(void);", "#ifdef __cplusplus", "}", "#endif", "#endif /* _FROM_ASM_ */", "",
+              "#endif /* BOARD_H */", ""]
+    return "\n".join(lines)
+
+
+def generateBoardSource(family, ports):
+    registers = [name for register, attribute, bits, width in
+                 gpioRegisters + (gpioV3Registers if chGpioVersion[family] == '3' else [])
+                 for name in (['AFRL', 'AFRH'] if register == 'AFR' else [register])]
+    lines = [BOARD_H_HEADER, '#include "hal.h"', "",
+             "#if HAL_USE_PAL || defined(__DOXYGEN__)",
+             "/**", " * @brief   PAL setup.",
+             " * @details Digital I/O ports static configuration as defined in @p board.h.",
+             " *          This variable is used by the HAL when initializing the PAL driver.", " */",
+             "const PALConfig pal_default_config = {"]
+    for portName, pinElems in ports:
+        values = ["VAL_%s_%s" % (portName, name) for name in registers]
+        lines += ["#if STM32_HAS_%s" % portName,
+                  "  {%s," % ", ".join(values[:4]),
+                  "   %s}," % ", ".join(values[4:]),
+                  "#endif"]
+    lines += ["};", "#endif", "",
+              "/**", " * @brief   Early initialization code.",
+              " * @details This initialization must be performed just after stack setup",
+              " *          and before any other initialization.", " */",
+              "void __early_init(void) {", "", "  stm32_clock_init();", "}", ""]
+    for driver, prefix in (('HAL_USE_SDC', 'sdc'), ('HAL_USE_MMC_SPI', 'mmc')):
+        driverType = 'SDCDriver *sdcp' if prefix == 'sdc' else 'MMCDriver *mmcp'
+        lines += ["#if %s || defined(__DOXYGEN__)" % driver,
+                  "/**", " * @brief   Card detect.", " */",
+                  "bool %s_lld_is_card_inserted(%s) {" % (prefix, driverType), "",
+                  "  (void)%sp;" % prefix, "  /* TODO: Fill the implementation.*/", "  return true;", "}", "",
+                  "/**", " * @brief   Write protect detection.", " */",
+                  "bool %s_lld_is_write_protected(%s) {" % (prefix, driverType), "",
+                  "  (void)%sp;" % prefix, "  /* TODO: Fill the implementation.*/", "  return false;", "}",
+                  "#endif", ""]
+    lines += ["/**", " * @brief   Board-specific initialization code.",
+              " * @todo    Add your board-specific code, if any.", " */",
+              "void boardInit(void) {", "}", ""]
+    return "\n".join(lines)
+
+
+# board.h / board.c of a board (.chcfg), as the ChibiOS templates generate them
+def generateBoardFiles(root, folder):
+    family = getTemplatesFamily(root)
+    ports = getBoardPorts(root)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    files = [(os.path.join(folder, 'board.h'), generateBoardHeader(root, family, ports)),
+             (os.path.join(folder, 'board.c'), generateBoardSource(family, ports))]
+    for fileName, text in files:
+        print("Writing %s" % fileName)
+        with open(fileName, 'w') as f:
+            f.write(text)
+    return [fileName for fileName, text in files]
@@ -18,39 +18,83 @@
     All CubeMX parsing and the "models: mcu, pin"
 """
 
-import sys
+import os
+import fnmatch
+import threading
+import cache
+import cubefiles
+import instrument
+import xmlbackend
 from utils import *
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 MCU_PATH = '/db/mcu/'
 IP_PATH = '/db/mcu/IP/'
 MCU_FAMILIES_PATH = '/db/mcu/families.xml'
-CUBE_PATH = None
+
+# how many MCU / GPIO models are kept in memory
+MCU_CACHE_SIZE = 64
+GPIO_CACHE_SIZE = 16
+SIGNAL_CACHE_SIZE = 64 * 1024
+
+# the GPIO modes files parsed in the background at once
+GPIO_LOAD_THREADS = 2
+
+# the chibi values of the pin properties - all the pins share the same strings
+class Mode:
+    Input = 'Input'
+    Output = 'Output'
+    Analog = 'Analog'
+    Alternate = 'Alternate'
+
+
+class Speed:
+    Minimum = 'Minimum'
+    Low = 'Low'
+    High = 'High'
+    Maximum = 'Maximum'
+
+
+class Resistor:
+    PullUp = 'PullUp'
+    PullDown = 'PullDown'
+    Floating = 'Floating'
+
+
+class Type:
+    PushPull = 'PushPull'
+    OpenDrain = 'OpenDrain'
+
+
+class Level:
+    High = 'High'
+    Low = 'Low'
+
 
 _resistor = {
-    'GPIO_PULLUP': 'PullUp',
-    'GPIO_PULLDOWN': 'PullDown',
-    'GPIO_NOPULL': 'Floating'
+    'GPIO_PULLUP': Resistor.PullUp,
+    'GPIO_PULLDOWN': Resistor.PullDown,
+    'GPIO_NOPULL': Resistor.Floating
 }
 
 _speed = {
-    'GPIO_SPEED_FREQ_LOW': 'Minimum',
-    'GPIO_SPEED_FREQ_MEDIUM': 'Low',
-    'GPIO_SPEED_FREQ_HIGH': 'High',
-    'GPIO_SPEED_FREQ_VERY_HIGH': 'Maximum',
+    'GPIO_SPEED_FREQ_LOW': Speed.Minimum,
+    'GPIO_SPEED_FREQ_MEDIUM': Speed.Low,
+    'GPIO_SPEED_FREQ_HIGH': Speed.High,
+    'GPIO_SPEED_FREQ_VERY_HIGH': Speed.Maximum,
 }
 
 # by default CubeMX is setting the GPIO as low
 _level = {
-    'GPIO_PIN_SET': 'High',
-    'GPIO_PIN_RESET': 'Low',
+    'GPIO_PIN_SET': Level.High,
+    'GPIO_PIN_RESET': Level.Low,
 }
 
 _signal = {
-    r'GPIO_Input': 'Input',
-    r'GPIO_Output': 'Output',
-    r'ADC[0-9x]+_IN[0-9]+': 'Analog',
-    r'IN[0-9]{1,2}': 'Analog',
+    r'GPIO_Input': Mode.Input,
+    r'GPIO_Output': Mode.Output,
+    r'ADC[0-9x]+_IN[0-9]+': Mode.Analog,
+    r'IN[0-9]{1,2}': Mode.Analog,
     # r'.*JTMS-SWDIO.*': 'Alternate',
     # r'.*JTCK-SWCLK.*': 'Alternate',
     # r'.*UART.*': 'Alternate',
@@ -58,113 +102,171 @@ _signal = {
 }
 
 _type = {
-    'GPIO_MODE_OUTPUT_OD': 'OpenDrain',
-    'GPIO_MODE_OUTPUT_PP': 'PushPull'
+    'GPIO_MODE_OUTPUT_OD': Type.OpenDrain,
+    'GPIO_MODE_OUTPUT_PP': Type.PushPull
+}
+
+# the CubeMX properties with default values in GPIO-<version>_Modes.xml
+_defaultParameters = (
+    'PinState',
+    'GPIO_ModeDefaultOutputPP',
+    'GPIO_Speed',
+    'GPIO_PuPd',
+    'GPIO_ModeDefaultPP',
+    'GPIO_ModeDefaultEXTI',
+    'GPIO_AF',
+    'GPIO_Speed_High_Default',
+)
+
+# CubeMX property -> chibi values
+_valueMaps = {
+    'GPIO_PuPd': _resistor,
+    'GPIO_Speed': _speed,
+    'PinState': _level,
+    'GPIO_ModeDefaultOutputPP': _type,
 }
 
-_defaultValues = {}
 
+# why a signal could not be resolved
+NO_DESCRIPTION = 'no GPIO description for the pin'
+NO_ALTERNATE = 'not an alternate function of the pin'
+INVALID_ALTERNATE = 'invalid alternate function value'
+
+UnresolvedSignal = namedtuple('UnresolvedSignal', ['pin', 'signal', 'reason'])
+
+
+class SignalClassifier:
+    """
+        Signal -> (chibi mode, alternate function, the reason if not resolved)
+        All the rules are checked with one compiled expression and the results are
+        memoized per GPIO IP version, pin and signal - one classifier per database
+    """
+    _alternate = re.compile(r'GPIO_AF([0-9]{1,2}).*')
+
+    def __init__(self, rules, cacheSize):
+        self.modes = []
+        exprs = []
+        for expr, mode in rules.items():
+            exprs.append('(?P<r%d>%s)' % (len(self.modes), expr))
+            self.modes.append(mode)
+        self.matcher = re.compile('|'.join(exprs))
+        self.memo = LruCache(cacheSize)
+
+    def classify(self, pin, signal):
+        key = (pin.getDefaults().version, pin.CName, signal)
+        result = self.memo.get(key)
+        if result is None:
+            result = self.memo[key] = self._classify_(pin._afTable, signal)
+        return result
+
+    def _classify_(self, afTable, signal):
+        m = self.matcher.match(signal)
+        if m:
+            return self.modes[int(m.lastgroup[1:])], None, None
+        # find alternate function
+        if afTable is None:
+            return Mode.Input, None, NO_DESCRIPTION
+        afValue = afTable.get(signal)
+        if afValue is None:
+            return Mode.Input, None, NO_ALTERNATE
+        m = self._alternate.match(afValue)
+        if m is None:
+            return Mode.Input, None, INVALID_ALTERNATE
+        return Mode.Alternate, m.group(1), None
 
-def getChibiValue(prop, cube2ch, cube):
-    if cube in cube2ch:
-        return cube2ch[cube]
-    elif prop in _defaultValues:
-        if _defaultValues[prop] in cube2ch:
-            return cube2ch[_defaultValues[prop]]
-    return None
+
+# for the MCUs without a database - nothing is memoized
+_noDbClassifier = SignalClassifier(_signal, 0)
 
 
 class Pin:
-    pinNo = -1
-    CName = "N/A"  # cube mx name
-    Pin = "N/A"
-    SignalName = None
-    AnalogSwitch = None
-    PinLocked = None
-    ID = None
-    Type = None
-    Level = None
-    Speed = None
-    Resistor = None
-    Mode = None
-    ModeCube = None
-    Alternate = None
-    _gpioDesc = None
-    _gpioNs = ''
-    parent = None
+    __slots__ = ('pinNo', 'CName', 'Pin', 'SignalName', 'AnalogSwitch', 'PinLocked', 'ID', 'Type',
+                 'Level', 'Speed', 'Resistor', 'Mode', 'ModeCube', 'Alternate', '_afTable', 'parent')
 
     def __init__(self):
-        pass
+        self.pinNo = -1
+        self.CName = "N/A"  # cube mx name
+        self.Pin = "N/A"
+        self.SignalName = None
+        self.AnalogSwitch = None
+        self.PinLocked = None
+        self.ID = None
+        self.Type = None
+        self.Level = None
+        self.Speed = None
+        self.Resistor = None
+        self.Mode = None
+        self.ModeCube = None
+        self.Alternate = None
+        self._afTable = None  # signal -> GPIO_AF value (e.g. GPIO_AF7_USART1)
+        self.parent = None
 
     def getModeFromSignal(self, signal):
-        mode = "Input"
-
-        for key in _signal:
-            if re.match(key, signal):
-                mode = _signal[key]
-                return mode
-        # find alternate function
-        if self._gpioDesc is not None:
-            pinSignal = getElem(self._gpioDesc, "PinSignal[@Name='%s']//{0}PossibleValue" % signal, self._gpioNs)
-            if pinSignal is not None:
-                # print ("Success for %s" % pinSignal.text)
-                expr = r'GPIO_AF([0-9]{1,2}).*'
-                m = re.match(expr, pinSignal.text)
-                if m and len(m.groups()) >= 1:
-                    mode = self.Mode = 'Alternate'
-                    self.Alternate = m.group(1)
-                    # print(signal, self.Mode, self.Alternate)
-                else:
-                    print("Failed to read %s" % signal)
-            else:
-                print("Failed: %s" % signal, self.CName, self.Pin)
-        else:
-            print("Invalid description - %s / %s " % (self.Pin, signal))
-
+        db = self.parent.db if self.parent is not None else None
+        classifier = db.classifier if db is not None else _noDbClassifier
+        mode, alternate, reason = classifier.classify(self, signal)
+        if alternate is not None:
+            self.Mode = mode
+            self.Alternate = alternate
+        if reason is not None and self.parent is not None:
+            self.parent.unresolved.append(UnresolvedSignal(self.CName, signal, reason))
         return mode
 
+    # returns True if the property is used
     def update(self, prop, value):
         updated = False
         if prop == 'GPIO_Label':
             self.ID = value
             updated = True
         elif prop == 'GPIO_PuPd':
-            self.Resistor = getChibiValue(prop, _resistor, value)
+            self.Resistor = self.getDefaults().getChibiValue(prop, value)
             updated = True
         elif prop == 'GPIO_Speed':
-            self.Speed = getChibiValue(prop, _speed, value)
+            self.Speed = self.getDefaults().getChibiValue(prop, value)
             updated = True
         elif prop == 'Signal':
             self.SignalName = value
-            self.Mode = self.getModeFromSignal(value)
+            with instrument.stage('getModeFromSignal'):
+                self.Mode = self.getModeFromSignal(value)
             updated = True
         elif prop == 'Mode':
             self.ModeCube = value  # the mode will be updated when signal is set
             updated = True
         elif prop == 'PinState':
-            self.Level = getChibiValue(prop, _level, value)
+            self.Level = self.getDefaults().getChibiValue(prop, value)
             updated = True
         elif prop == 'GPIO_ModeDefaultOutputPP':
-            self.Type = getChibiValue(prop, _type, value)
+            self.Type = self.getDefaults().getChibiValue(prop, value)
             updated = True
         else:
             print("{0}: property {1} is not used? {2}".format(self.CName, prop, value))
+        return updated
+
+    def updateAll(self, props):
+        updated = False
+        for prop in props:
+            updated = self.update(prop, props[prop]) or updated
 
         # load all default values for a Pin that is defined in Cube project
         # in this way, all default Chibi properties should be overridden
         if updated:
             self.loadDefaults()
 
+    def getDefaults(self):
+        if self.parent is None or self.parent.gpioDefaults is None:
+            return NO_DEFAULTS
+        return self.parent.gpioDefaults
+
     # Load default value ONLY if is not loaded yet
     # these default values are default in CubeMX
     def loadDefaults(self):
-        emptyDict = {}
+        defaults = self.getDefaults().chibi
         self.ID = '' if self.ID is None else self.ID
-        self.Resistor = getChibiValue('GPIO_PuPd', _resistor, 'N/A') if self.Resistor is None else self.Resistor
-        self.Speed = getChibiValue('GPIO_Speed', _speed, 'N/A') if self.Speed is None else self.Speed
-        self.Mode = 'Input' if self.Mode is None else self.Mode
-        self.Level = getChibiValue('PinState', _level, 'N/A') if self.Level is None else self.Level
-        self.Type = getChibiValue('GPIO_ModeDefaultOutputPP', _type, 'N/A') if self.Type is None else self.Type
+        self.Resistor = defaults.get('GPIO_PuPd') if self.Resistor is None else self.Resistor
+        self.Speed = defaults.get('GPIO_Speed') if self.Speed is None else self.Speed
+        self.Mode = Mode.Input if self.Mode is None else self.Mode
+        self.Level = defaults.get('PinState') if self.Level is None else self.Level
+        self.Type = defaults.get('GPIO_ModeDefaultOutputPP') if self.Type is None else self.Type
         self.Alternate = '0' if self.Alternate is None else self.Alternate
 
     def __str__(self):
@@ -172,63 +274,58 @@ class Pin:
 
 
 class MCU:
-    partNumber = None
-    name = ""
-    pins = {}
-    ports = defaultdict(list)
-    gpiosDesc = None
-    HSEClock = None
-    LSEClock = None
-    VDD = None
-    Family = None
-    CubeFile = ""
-
-    def __init__(self, partNo):
+    __slots__ = ('partNumber', 'db', 'name', 'pins', 'ports', 'table', 'gpioDefaults', 'unresolved',
+                 'HSEClock', 'LSEClock', 'VDD', 'Family', 'CubeFile')
+
+    def __init__(self, partNo, db=None):
         self.partNumber = partNo
+        self.db = db  # the CubeDB the MCU was loaded from
         self.name = ""
         self.pins = {}
         self.ports = defaultdict(list)
-        self.gpiosDesc = None
+        # port x pin number -> pin, for the GPIO pins
+        self.table = [None] * (len(PORTS) * MAX_PINS_PER_PORT)
+        self.gpioDefaults = None
+        self.unresolved = []  # UnresolvedSignal of the signals without a mode
         self.HSEClock = None
         self.LSEClock = None
         self.VDD = None
         self.Family = None
         self.CubeFile = ""
 
-    def updateProperties(self, props):
+    def getPin(self, port, pinNo):
+        if port is None or pinNo is None or port not in PORTS or not 0 <= pinNo < MAX_PINS_PER_PORT:
+            return None
+        return self.table[PORTS.index(port) * MAX_PINS_PER_PORT + pinNo]
+
+    def updateProperties(self, project):
+        if not isinstance(project, IOCProject):
+            project = IOCProject(project)
         count = 0
         dummy = {}
-        for key in props:
-            processed = False
-            m = re.match(r'(P[A-K][0-9]{1,2})\.(.*)', key, flags=re.IGNORECASE)
-            if m and len(m.groups()) == 2:
-                gpioName = m.group(1)
-                gpioProp = m.group(2)
-                port, pin = getPortInfo(gpioName)
-                pinName = getPinName(port, pin)
-                pin = self.pins[pinName] if pinName in self.pins else None
-                if pin is not None:
-                    dummy[pin.Pin] = "dummy"
-                    pin.update(gpioProp, props[key])
-                    count += 1
-                else:
-                    print("%s was not found in pins??" % gpioName)
-
-        #     else:
-        #         print("%s is not a GPIO" % key)
-            if not processed:  # try RCC - clocks
-                if key == 'RCC.HSE_VALUE':
-                    self.HSEClock = props[key]
-                elif key == 'PCC.Vdd':
-                    try:
-                        vdd = float(props[key]) * 100
-                        self.VDD = str(int(vdd))
-                    except:
-                        pass
-                elif key == 'RCC.LSE_VALUE':
-                    self.LSEClock = props[key]
-                # elif key == '':
-                # elif key == '':
+        for gpioName, props in project.pins.items():
+            port, pinNo = getPortInfo(gpioName)
+            pin = self.getPin(port, pinNo)
+            if pin is not None:
+                dummy[pin.Pin] = "dummy"
+                pin.updateAll(props)
+                count += len(props)
+            else:
+                print("%s was not found in pins??" % gpioName)
+
+        # RCC - clocks
+        rcc = project.getIP('RCC')
+        if 'HSE_VALUE' in rcc:
+            self.HSEClock = rcc['HSE_VALUE']
+        if 'LSE_VALUE' in rcc:
+            self.LSEClock = rcc['LSE_VALUE']
+        pcc = project.getIP('PCC')
+        if 'Vdd' in pcc:
+            try:
+                vdd = float(pcc['Vdd']) * 100
+                self.VDD = str(int(vdd))
+            except:
+                pass
         print("%s properties of %d GPIOs were updated from CubeMX project" %
               (count, len(dummy)))
 
@@ -236,146 +333,489 @@ class MCU:
         return "MCU: %s\nName: %s" % (self.partNumber, self.name)
 
 
-def getDefaultValue(parent, ns, refName):
-    retVal = None
-    elem = getElem(parent, "RefParameter[@Name='%s']" % refName, ns)
-    if elem is not None and 'DefaultValue' in elem.attrib:
-        retVal = elem.attrib['DefaultValue']
+# the first RefParameter of each name, as the CubeMX default values
+def loadDefaultValues(gpio, ns):
+    retVal = {}
+    found = set()
+    for elem in getElems(gpio, "RefParameter", ns):
+        name = elem.attrib.get('Name')
+        if name in _defaultParameters and name not in found:
+            found.add(name)
+            if 'DefaultValue' in elem.attrib:
+                retVal[name] = elem.attrib['DefaultValue']
 
     return retVal
 
 
-def loadDefaultValues(gpio, ns):
-    retVal = {}
+class GpioDefaults:
+    """
+        The default values of a GPIO IP version, as CubeMX and as chibi values.
+        Shared by all the MCUs with the same GPIO IP, never changed once created.
+    """
+    __slots__ = ('version', 'values', 'chibi')
 
-    val = getDefaultValue(gpio, ns, 'PinState')
-    if val is not None:
-        retVal['PinState'] = val
+    def __init__(self, version, values):
+        self.version = version
+        self.values = values
+        self.chibi = {}
+        for prop, cube2ch in _valueMaps.items():
+            if values.get(prop) in cube2ch:
+                self.chibi[prop] = cube2ch[values[prop]]
 
-    val = getDefaultValue(gpio, ns, 'GPIO_ModeDefaultOutputPP')
-    if val is not None:
-        retVal['GPIO_ModeDefaultOutputPP'] = val
+    def getChibiValue(self, prop, cube):
+        cube2ch = _valueMaps[prop]
+        if cube in cube2ch:
+            return cube2ch[cube]
+        return self.chibi.get(prop)
 
-    val = getDefaultValue(gpio, ns, 'GPIO_Speed')
-    if val is not None:
-        retVal['GPIO_Speed'] = val
 
-    val = getDefaultValue(gpio, ns, 'GPIO_PuPd')
-    if val is not None:
-        retVal['GPIO_PuPd'] = val
+NO_DEFAULTS = GpioDefaults(None, {})
 
-    val = getDefaultValue(gpio, ns, 'GPIO_ModeDefaultPP')
-    if val is not None:
-        retVal['GPIO_ModeDefaultPP'] = val
 
-    val = getDefaultValue(gpio, ns, 'GPIO_ModeDefaultOutputPP')
-    if val is not None:
-        retVal['GPIO_ModeDefaultOutputPP'] = val
+# RefName -> (MCU file name, family) for all the MCUs from families.xml
+def buildFamiliesIndex(fileName, backend=None):
+    index = {}
+    for mcuDesc, ns, parents in iterElems(fileName, ('Mcu',), backend, True):
+        try:
+            # Family / SubFamily / Mcu
+            family = parents[-2].attrib['Name'] + 'xx'
+        except:
+            family = None
+        refName = mcuDesc.attrib.get('RefName')
+        if refName in index:
+            # ambiguous part number - the same as not found
+            index[refName] = None
+        elif refName is not None:
+            index[refName] = (mcuDesc.attrib['Name'], family)
+    return index
+
+
+def createPin(mcu, position, cName):
+    pin = Pin()
+    pin.parent = mcu
+    pin.pinNo = position
+    pin.CName = cName
+    port, pinNo = getPortInfo(pin.CName)
+    pinName = getPinName(port, pinNo)
+    pin.Pin = pinName if not isEmpty(pinName) else pin.CName
+    return pin
+
+
+def addPin(mcu, pin):
+    mcu.pins[pin.Pin] = pin
+    port, pinNo = getPortInfo(pin.CName)
+    if port is not None and pinNo is not None:
+        mcu.ports[port].append(pinNo)
+        if pinNo < MAX_PINS_PER_PORT:
+            mcu.table[PORTS.index(port) * MAX_PINS_PER_PORT + pinNo] = pin
+
+
+# signal -> GPIO_AF value for a GPIO_Pin element of gpio-xxx_modes.xml
+def getAlternateTable(gpioDesc, ns):
+    table = {}
+    for pinSignal in getElems(gpioDesc, "PinSignal", ns):
+        value = getElem(pinSignal, "PossibleValue", ns)
+        if value is not None and 'Name' in pinSignal.attrib:
+            table.setdefault(pinSignal.attrib['Name'], value.text)
+    return table
+
+
+# pin name -> alternate table of the GPIO_Pin elements of gpio-xxx_modes.xml
+def getAlternateTables(root, ns):
+    afTables = {}
+    for gpioDesc in getElems(root, "GPIO_Pin", ns):
+        name = gpioDesc.attrib.get('Name')
+        # keep the first description, as the linear search did
+        if name is not None and name not in afTables:
+            afTables[name] = getAlternateTable(gpioDesc, ns)
+    return afTables
+
+
+class GpioModes:
+    """
+        What is used from GPIO-<version>_Modes.xml: the defaults and the alternate tables by
+        pin name - plain data, the xml is released once they are extracted
+    """
+    __slots__ = ('version', 'defaults', 'afTables')
+
+    def __init__(self, version, defaults, afTables):
+        self.version = version
+        self.defaults = defaults
+        self.afTables = afTables
+
+
+# the MCU model as plain data - this is what is cached
+def compileMCU(mcu):
+    pins = [(pin.pinNo, pin.CName, pin._afTable) for pin in mcu.pins.values()]
+    return {
+        'name': mcu.name,
+        'family': mcu.Family,
+        'gpioVersion': mcu.gpioDefaults.version if mcu.gpioDefaults is not None else None,
+        'defaults': mcu.gpioDefaults.values if mcu.gpioDefaults is not None else {},
+        'pins': pins,
+    }
+
+
+class CubeError(Exception):
+    """
+        A conversion error; exitCode is the exit code of the script for it
+    """
+
+    def __init__(self, message, exitCode=-1):
+        Exception.__init__(self, message)
+        self.exitCode = exitCode
+
+
+class CubeDB:
+    """
+        A STM32CubeMX database: the path (the installation folder or a zip / tar archive of it),
+        the cache folder and the models loaded from it.
+        The models are shared by the MCUs; the database can be used from more threads
+    """
+
+    def __init__(self, path, cachePath=None, xml=None):
+        try:
+            self.files = cubefiles.openFiles(path)
+        except (OSError, IOError) as ex:
+            raise CubeError("Failed to open %s - %s" % (path, ex), -3)
+        if self.files is None:
+            raise CubeError("%s is neither a folder nor a zip / tar archive" % path, -3)
+        self.path = path
+        self.cachePath = cachePath  # None - the user cache folder
+        self.xml = xmlbackend.getBackend(xml)  # the xml backend name, None - the default one
+        self.familiesIndex = None  # (families.xml signature, index)
+        self.mcuData = LruCache(MCU_CACHE_SIZE)
+        self.mcuFiles = LruCache(MCU_CACHE_SIZE)
+        self.gpioModes = LruCache(GPIO_CACHE_SIZE)
+        self.gpioDefaults = LruCache(GPIO_CACHE_SIZE)
+        self.classifier = SignalClassifier(_signal, SIGNAL_CACHE_SIZE)
+        self.modelsVersion = None  # the families.xml signature of the models in memory
+        # the models loaded in the background, the threads are started when first needed
+        self.loadingLock = threading.Lock()
+        self.gpioLoading = {}  # gpio version -> future
+        self.gpioLoader = None
+        self.mcuLoader = None
+
+    # forget the models loaded in memory
+    def clear(self):
+        self.familiesIndex = None
+        for memo in (self.mcuData, self.mcuFiles, self.gpioModes, self.gpioDefaults, self.classifier.memo):
+            memo.clear()
+        with self.loadingLock:
+            self.gpioLoading.clear()
+
+    # the models in memory are keyed only by the GPIO version / MCU file name: they are
+    # forgotten when the database is changed, not to be cached as the ones of the new version
+    def checkVersion(self, signature):
+        with self.loadingLock:
+            changed = signature != self.modelsVersion
+            self.modelsVersion = signature
+        if changed:
+            self.clear()
+
+    # the CubeMX database is identified by the path and families.xml
+    def getVersion(self):
+        return os.path.abspath(self.path), self.files.getSignature(MCU_FAMILIES_PATH)
+
+    # read(fileName, backend) of a file of the database: a file that cannot be read fails the
+    # loading, so an incomplete model is never cached
+    def readFile(self, relPath, read):
+        try:
+            return read(self.files.open(relPath), self.xml)
+        except (OSError, IOError) as ex:
+            raise CubeError("Failed to load %s - %s" % (self.files.getName(relPath), ex), -2)
+
+    # the cache entries of a database version are kept in their own folder: the entries of
+    # the old versions are not used anymore and are evicted when the cache is full
+    def getCacheName(self, kind, key=None):
+        name = 'db-%s/%s' % (cache.getKey(*self.getVersion()), kind)
+        return name if key is None else name + '-' + cache.getKey(key)
+
+    # the index is rebuilt only when families.xml is changed
+    def loadFamiliesIndex(self):
+        signature = self.files.getSignature(MCU_FAMILIES_PATH)
+        self.checkVersion(signature)
+        familiesIndex = self.familiesIndex
+        if familiesIndex is not None and familiesIndex[0] == signature and signature is not None:
+            return familiesIndex[1]
+
+        with instrument.stage('familiesIndex'):
+            index = cache.loadOrBuild(self.getCacheName('families'), signature,
+                                      lambda: self.readFile(MCU_FAMILIES_PATH, buildFamiliesIndex), self.cachePath)
+            self.familiesIndex = (signature, index)
+        return index
+
+    # the (RefName, family) of the MCUs from families.xml, optionally only of a family
+    # (STM32F4 or STM32F4xx) and / or matching one of the RefName patterns (e.g. STM32F407*)
+    def findMCUs(self, family=None, patterns=None):
+        if family is not None:
+            family = family.upper()
+            family = family if family.endswith('XX') else family + 'XX'
+        patterns = [pattern.upper() for pattern in patterns or []]
+        mcus = []
+        for refName, mcuInfo in self.loadFamiliesIndex().items():
+            if mcuInfo is None:
+                continue
+            if family is not None and (mcuInfo[1] or '').upper() != family:
+                continue
+            if patterns and not any(fnmatch.fnmatchcase(refName.upper(), pattern) for pattern in patterns):
+                continue
+            mcus.append((refName, mcuInfo[1]))
+        return sorted(mcus, key=lambda mcu: (str(mcu[1]), mcu[0]))
+
+    def getGpioDefaults(self, gpioVersion, values):
+        defaults = self.gpioDefaults.get(gpioVersion)
+        if defaults is None:
+            defaults = self.gpioDefaults[gpioVersion] = GpioDefaults(gpioVersion, values)
+        return defaults
+
+    # GPIO modes files are shared by many MCUs, so each version is indexed only once
+    # (and cached, for the new MCUs of the same GPIO version)
+    def getGpioModes(self, gpioVersion):
+        gpioModes = self.gpioModes.get(gpioVersion)
+        if gpioModes is None:
+            with instrument.stage('gpioModes'):
+                with self.loadingLock:
+                    future = self.gpioLoading.pop(gpioVersion, None)
+                gpioModes = self._getGpioModes_(gpioVersion, future.result() if future is not None else None)
+        return gpioModes
+
+    # the GPIO modes file is read in a thread while the MCU file is still parsed: only with
+    # lxml, it parses without holding the GIL (expat doesn't release it, nothing is gained).
+    # The models are still built by the calling thread
+    def prefetchGpioModes(self, gpioVersion):
+        with self.loadingLock:
+            if gpioVersion in self.gpioLoading or self.gpioModes.get(gpioVersion) is not None:
+                return
+            if self.gpioLoader is None:
+                import concurrent.futures
+                self.gpioLoader = concurrent.futures.ThreadPoolExecutor(GPIO_LOAD_THREADS)
+            self.gpioLoading[gpioVersion] = self.gpioLoader.submit(self._readGpioModes_, gpioVersion)
+
+    # (cached data, None) or (None, (root, ns) of the GPIO modes file)
+    def _readGpioModes_(self, gpioVersion):
+        data = cache.load(self.getCacheName('gpio', gpioVersion), self.getVersion()[1], self.cachePath)
+        if data is not None:
+            return data, None
+        return None, self.readFile(IP_PATH + ("GPIO-%s_Modes.xml" % gpioVersion),
+                                   lambda fileName, backend: getRoot(fileName, backend, True))
+
+    def _getGpioModes_(self, gpioVersion, read=None):
+        gpioModes = self.gpioModes.get(gpioVersion)
+        if gpioModes is not None:
+            return gpioModes
+        name = self.getCacheName('gpio', gpioVersion)
+        signature = self.getVersion()[1]
+        data, parsed = read if read is not None else (cache.load(name, signature, self.cachePath), None)
+        if data is None:
+            with cache.lock(name, self.cachePath):
+                data = cache.load(name, signature, self.cachePath)
+                if data is None:
+                    gpioDesc, gns = parsed or self._readGpioModes_(gpioVersion)[1]
+                    data = {'defaults': loadDefaultValues(gpioDesc, gns), 'afTables': getAlternateTables(gpioDesc, gns)}
+                    cache.store(name, signature, data, self.cachePath)
+        gpioModes = GpioModes(gpioVersion, self.getGpioDefaults(gpioVersion, data['defaults']), data['afTables'])
+        self.gpioModes[gpioVersion] = gpioModes
+        return gpioModes
+
+    # only the GPIO IP and the pins are needed from the MCU file - the same file
+    # describes several part numbers (e.g. STM32F407VETx and STM32F407VGTx).
+    # The IPs are before the pins: with lxml the GPIO modes file is loaded meanwhile
+    def loadMCUFile(self, name):
+        result = self.mcuFiles.get(name)
+        if result is None:
+            gpioIp = []
+            pinsDesc = []
+
+            def read(fileName, backend):
+                for elem, ns, parents in iterElems(fileName, ('IP', 'Pin'), backend, True):
+                    if elem.tag == ns + 'Pin':
+                        pinsDesc.append((elem.attrib['Position'], elem.attrib['Name']))
+                    elif elem.attrib.get('Name') == 'GPIO':
+                        gpioIp.append(elem.attrib['Version'])
+                        if backend is xmlbackend.LXML:
+                            self.prefetchGpioModes(elem.attrib['Version'])
+
+            self.readFile(MCU_PATH + name + ".xml", read)
+            if len(gpioIp) > 1:
+                # not used - an invalid GPIO description, don't keep the xml read meanwhile
+                with self.loadingLock:
+                    for gpioVersion in gpioIp:
+                        self.gpioLoading.pop(gpioVersion, None)
+            result = self.mcuFiles[name] = (gpioIp, pinsDesc)
+        return result
+
+    # the MCU is loaded in a thread (e.g. the MCU of a project read ahead), getMCU waits for it;
+    # a failure is reported when the MCU is used
+    def prefetchMCU(self, partNo):
+        with self.loadingLock:
+            if self.mcuLoader is None:
+                import concurrent.futures
+                self.mcuLoader = concurrent.futures.ThreadPoolExecutor(1)
+            self.mcuLoader.submit(self._prefetchMCU_, partNo)
+
+    def _prefetchMCU_(self, partNo):
+        try:
+            self.getMCU(partNo)
+        except CubeError:
+            pass
 
-    val = getDefaultValue(gpio, ns, 'GPIO_ModeDefaultEXTI')
-    if val is not None:
-        retVal['GPIO_ModeDefaultEXTI'] = val
+    # the compiled data is also kept in memory: the next MCU with the same part
+    # number (e.g. in batch mode) is built without touching the disk.
+    # Each call returns a new MCU; raises CubeError if the MCU is not found
+    def getMCU(self, partNo):
+        signature = self.getVersion()[1]
+        self.checkVersion(signature)
+        name = self.getCacheName('mcu', partNo)
+        data = self.mcuData.get(name)
+        if data is None:
+            data = cache.load(name, signature, self.cachePath)
+            if data is None:
+                # the other processes loading the same MCU wait and use the cached data
+                with cache.lock(name, self.cachePath):
+                    data = cache.load(name, signature, self.cachePath)
+                    if data is None:
+                        mcu = self._load_(partNo)
+                        if mcu is not None:
+                            data = self.mcuData[name] = compileMCU(mcu)
+                            cache.store(name, signature, data, self.cachePath)
+                        return mcu
+            print("Loading %s from cache" % partNo)
+        self.mcuData[name] = data
+        return self._build_(partNo, data)
+
+    def _build_(self, partNo, data):
+        mcu = MCU(partNo, self)
+        mcu.name = data['name']
+        mcu.Family = data['family']
+        mcu.gpioDefaults = self.getGpioDefaults(data['gpioVersion'], data['defaults'])
+        for position, cName, afTable in data['pins']:
+            pin = createPin(mcu, position, cName)
+            pin._afTable = afTable
+            addPin(mcu, pin)
+        print("%s has %d pins (cached)" % (mcu.partNumber, len(mcu.pins)))
+        return mcu
+
+    def _load_(self, partNo):
+        mcu = MCU(partNo, self)
+
+        print("Loading %s" % mcu.partNumber)
+        mcuInfo = self.loadFamiliesIndex().get(mcu.partNumber)
+        if mcuInfo is None:
+            raise CubeError("Cannot identify the MCU (%s)" % mcu.partNumber, -4)
+        try:
+            mcu.name, mcu.Family = mcuInfo
+            with instrument.stage('mcuFile'):
+                gpioIp, pinsDesc = self.loadMCUFile(mcu.name)
+            if len(gpioIp) == 1:
+                gpioVersion = gpioIp[0]
+                print("GPIO version is '%s'" % gpioVersion)
+                gpioModes = self.getGpioModes(gpioVersion)
+                mcu.gpioDefaults = gpioModes.defaults
+            else:
+                gpioModes = None
+                print ("Invalid GPIO description")
+            print("%s has %d pins" % (partNo, len(pinsDesc)))
+            count = 0
+            alreadyExists = 0
+            duplicates = {}
+            with instrument.stage('pinBinding'):
+                for position, cName in pinsDesc:
+                    pin = createPin(mcu, position, cName)
+
+                    # find gpio description from gpio-xxx_modes.xml
+                    if gpioModes is not None:
+                        pin._afTable = gpioModes.afTables.get(pin.CName)
+
+                    if pin.Pin in mcu.pins:
+                        alreadyExists += 1
+                        duplicates[pin.Pin] = "dummy"
+                    addPin(mcu, pin)
+                    count += 1
 
-    val = getDefaultValue(gpio, ns, 'GPIO_AF')
-    if val is not None:
-        retVal['GPIO_AF'] = val
+            print("%s has %d pins (%d) (%d duplicates - %s)" % (
+                mcu.partNumber, len(mcu.pins), count, alreadyExists, str(duplicates.keys())))
+        except KeyError as xxx:
+            mcu = None
+            print("Failed to load %s because of %s" % (partNo, xxx))
 
-    val = getDefaultValue(gpio, ns, 'GPIO_Speed_High_Default')
-    if val is not None:
-        retVal['GPIO_Speed_High_Default'] = val
+        return mcu
 
-    return retVal
 
+_iocLine = re.compile(r'^[ \t]*([^#\s=][^=\r\n]*)=([^\r\n]*)', re.MULTILINE)
+_iocPin = re.compile(r'(P[A-K][0-9]{1,2})\.(.*)', re.IGNORECASE)
 
-def _load_(partNo):
-    mcu = MCU(partNo)
 
-    print("Loading %s" % mcu.partNumber)
-    try:
-        root, ns = getRoot(CUBE_PATH + MCU_FAMILIES_PATH)
-        if root is None or ns is None:
-            return None
-        elems = getElems(root, "Mcu[@RefName='%s']" % mcu.partNumber, ns)
-        if elems is None or len(elems) != 1:
-            print("Cannot identify the MCU (%s)" % mcu.partNumber)
-            sys.exit(-4)
-        mcuDesc = elems[0]
-        try:
-            mcu.Family = mcuDesc.getparent().getparent().attrib['Name'] + 'xx'
-        except:
-            pass
+class IOCProject:
+    """
+        The properties of a CubeMX project, also grouped per pin (PA0 -> {Signal: ...})
+        and per IP namespace (RCC -> {HSE_VALUE: ...})
+    """
+    properties = {}
+    pins = {}
+    ips = {}
 
-        mcu.name = mcuDesc.attrib['Name']
-        mcuDesc, ns = getRoot(CUBE_PATH + MCU_PATH + mcu.name + ".xml")
-        gpioIp = getElems(mcuDesc, "IP[@Name='GPIO']", ns)
-        if len(gpioIp) == 1:
-            gpioVersion = gpioIp[0].attrib['Version']
-            print("GPIO version is '%s'" % gpioVersion)
-            gpioDesc, gns = getRoot(CUBE_PATH + IP_PATH + ("GPIO-%s_Modes.xml" % gpioVersion))
-            global _defaultValues
-            _defaultValues = loadDefaultValues(gpioDesc, gns)
-            mcu.gpiosDesc = getElems(gpioDesc, "GPIO_Pin", gns)
-            # print(self.gpiosDesc)
+    def __init__(self, properties=None):
+        self.properties = {}
+        self.pins = {}
+        self.ips = {}
+        if properties is not None:
+            for key in properties:
+                self.add(key, properties[key])
+
+    def add(self, key, value):
+        self.properties[key] = value
+        m = _iocPin.match(key)
+        if m:
+            self.pins.setdefault(m.group(1), {})[m.group(2)] = value
         else:
-            print ("Invalid GPIO description")
-        pinsDesc = getElems(mcuDesc, "Pin", ns)
-        print("%s has %d pins" % (partNo, len(pinsDesc)))
-        count = 0
-        alreadyExists = 0
-        duplicates = {}
-        for pinDesc in pinsDesc:
-            pin = Pin()
-            pin.parent = mcu
-            pin.pinNo = pinDesc.attrib['Position']
-            pin.CName = pinDesc.attrib['Name']
-            port, pinNo = getPortInfo(pin.CName)
-            pinName = getPinName(port, pinNo)
-            pin.Pin = pinName if not isEmpty(pinName) else pin.CName
+            ns, sep, prop = key.partition('.')
+            if not sep:
+                ns, prop = '', key
+            self.ips.setdefault(ns, {})[prop] = value
+
+    def getIP(self, ns):
+        return self.ips.get(ns, {})
 
-            # find gpio description from gpio-xxx_modes.xml
-            gpio_desc = [i for i in mcu.gpiosDesc if
-                        i.attrib['Name'] == pin.CName]
-            pin._gpioDesc = gpio_desc[0] if len(gpio_desc) >= 1 else None
+    # the values used for the board clocks
+    def getClocks(self):
+        rcc = self.getIP('RCC')
+        return rcc.get('HSE_VALUE'), rcc.get('LSE_VALUE'), self.getIP('PCC').get('Vdd')
 
-            pin._gpioNs = gns
+    # the GPIO pins [(port, pin number)] with different properties in the other project
+    def getChangedPins(self, other):
+        changed = []
+        for name in set(self.pins) | set(other.pins):
+            if self.pins.get(name) != other.pins.get(name):
+                port, pinNo = getPortInfo(name)
+                if port is not None and pinNo is not None:
+                    changed.append((port, pinNo))
+        return sorted(changed)
 
-            if pin.Pin in mcu.pins:
-                alreadyExists += 1
-                duplicates[pin.Pin] = "dummy"
-            mcu.pins[pin.Pin] = pin
-            count += 1
+    def get(self, key, default=None):
+        return self.properties.get(key, default)
 
-            if port is not None and pinNo is not None:
-                mcu.ports[port].append(pinNo)
+    def __contains__(self, key):
+        return key in self.properties
 
-        print("%s has %d pins (%d) (%d duplicates - %s)" % (
-            mcu.partNumber, len(mcu.pins), count, alreadyExists, str(duplicates.keys())))
-    except KeyError as xxx:
-        mcu = None
-        print("Failed to load %s because of %s" % (partNo, xxx))
+    def __getitem__(self, key):
+        return self.properties[key]
 
-    return mcu
+    def __iter__(self):
+        return iter(self.properties)
 
+    def __len__(self):
+        return len(self.properties)
 
-def getMCU(partNo):
-    mcu = _load_(partNo)
-    return mcu
+
+def parseIOC(text):
+    project = IOCProject()
+    for m in _iocLine.finditer(text):
+        project.add(m.group(1), m.group(2).rstrip())
+    return project
 
 
 def loadIOC(filename):
-    lines = {}
     with open(filename) as f:
-        while True:
-            line = f.readline().strip()
-            if not line:
-                break
-            if line[0] == '#':
-                continue
-            # print(line)
-            vals = line.split('=', 2)
-            key = vals[0]
-            value = vals[1]
-            lines[key] = value
-
-    return lines
+        return parseIOC(f.read())
 
@@ -16,68 +16,681 @@
 
 import os
 import sys
+import json
 import argparse
+import contextlib
+import functools
+import signal
 import cube
 import chibi
+import cache
+import instrument
+import xmlbackend
 
 
-CUBE_PATH = None
+VERSION = '1.1.0'
+PROFILES = []  # the instrument reports of the converted files, if enabled
 
 
-def processFile(iCube, iChibi, oChibi):
+def getPartNumber(properties):
+    for key in ['PCC.PartNumber', 'Mcu.UserName']:
+        if key in properties:
+            return properties[key]
+    return None
+
+
+class Board:
+    """
+        A converted board: the part number, the .chcfg content and its root element
+    """
+
+    def __init__(self, partNumber, data, root=None, unresolved=(), cached=False):
+        self.partNumber = partNumber
+        self.data = data
+        self.root = root
+        self.unresolved = list(unresolved)  # cube.UnresolvedSignal
+        self.cached = cached  # from the results cache
+
+    def getRoot(self):
+        if self.root is None:
+            self.root = chibi.parseBoard(self.data)
+        return self.root
+
+    def write(self, fileName):
+        try:
+            with open(fileName, 'wb') as f:
+                f.write(self.data)
+        except (OSError, IOError) as ex:
+            raise cube.CubeError("Failed to save the result in %s - %s" % (fileName, ex))
+
+
+class Converter:
+    """
+        The library API: converts CubeMX projects with a database loaded once.
+        A failure raises cube.CubeError; a converter can be used from more threads
+    """
+
+    def __init__(self, cubePath, cachePath=None, useResults=True, xml=None):
+        self.db = cube.CubeDB(cubePath, cachePath, xml)
+        self.useResults = useResults
+
+    # the result depends only on the project, the chibi input, the CubeMX database and this script
+    def getResultKey(self, iocText, iCube, iChibi):
+        chibiText = None
+        if iChibi is not None and os.path.isfile(iChibi):
+            with open(iChibi, 'rb') as f:
+                chibiText = f.read()
+        return cache.getKey(VERSION, cache.FORMAT, self.db.getVersion(), iCube, iocText, iChibi, chibiText)
+
+    def getMCU(self, partNo):
+        with instrument.stage('getMCU'):
+            mcu = self.db.getMCU(partNo)
+        if not mcu:
+            raise cube.CubeError("Failed to load %s" % partNo)
+        return mcu
+
+    # the board of the project content; iCube is the name of the project (written in the board)
+    # and iChibi the initial board file, optional
+    def convertText(self, iocText, iCube='<iocText>', iChibi=None):
+        key = self.getResultKey(iocText, iCube, iChibi) if self.useResults else None
+        if key is not None:
+            with instrument.stage('resultsCache'):
+                result = cache.loadResult(key, self.db.cachePath)
+            if result is not None:
+                partNo, data = result
+                return Board(partNo, data, cached=True)
+
+        with instrument.stage('loadIOC'):
+            properties = cube.parseIOC(iocText)
+        partNo = getPartNumber(properties)
+        print(partNo)
+        if partNo is None:
+            raise cube.CubeError("Failed to identify the part number in the specified file %s" % iCube)
+        mcu = self.getMCU(partNo)
+        mcu.CubeFile = iCube
+        with instrument.stage('updateProperties'):
+            mcu.updateProperties(properties)
+        with instrument.stage('generateConfig'):
+            root = chibi.generateConfig(mcu, iChibi)
+            data = chibi.serializeBoard(root)
+        if key is not None:
+            cache.storeResult(key, (partNo, data), self.db.cachePath)
+        return Board(partNo, data, root, mcu.unresolved)
+
+    def convertFile(self, iCube, iChibi=None):
+        if not os.path.isfile(iCube):
+            raise cube.CubeError("File %s doesn't exist" % iCube, -2)
+        with instrument.stage('loadIOC'):
+            with open(iCube) as f:
+                iocText = f.read()
+        return self.convertText(iocText, iCube, iChibi)
+
+    # the default board of a part number, as converted from a project without any pin configured
+    def exportMCU(self, partNo, iChibi=None):
+        mcu = self.getMCU(partNo)
+        mcu.CubeFile = "<none - default board of %s>" % partNo
+        with instrument.stage('generateConfig'):
+            root = chibi.generateConfig(mcu, iChibi)
+            data = chibi.serializeBoard(root)
+        return Board(partNo, data, root)
+
+
+def processFile(converter, iCube, iChibi, oChibi, boardFolder=None):
     print("Starting to parse %s" % iCube)
     # validate params
-    mcu = None
     if not os.path.isfile(iCube):
-        print("File %s doesn't exist" % iCube)
-        sys.exit(-2)
-    if not os.path.isdir(CUBE_PATH):
-        print("Folder %s doesn't exist" % CUBE_PATH)
-        sys.exit(-3)
-    properties = cube.loadIOC(iCube)
-    partNo = None
-    for key in ['PCC.PartNumber', 'Mcu.UserName']:
+        raise cube.CubeError("File %s doesn't exist" % iCube, -2)
+    instrument.begin()
+    try:
+        with instrument.stage('loadIOC'):
+            with open(iCube) as f:
+                iocText = f.read()
+        return processIOC(converter, iocText, iCube, iChibi, oChibi, boardFolder)
+    finally:
+        if instrument.ENABLED:
+            PROFILES.append(instrument.end(iCube))
+
+
+# the folder of board.h / board.c: by default, output_path of the board - relative to the .chcfg, as ChibiStudio does
+def getBoardFolder(root, oChibi, boardFolder):
+    if boardFolder:
+        return boardFolder
+    path = chibi.getSectionText(root.find('{*}' + chibi.ct['conf']), chibi.ct['out'], '..')
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(oChibi)), path))
+
+
+# board.h / board.c of the converted board, if boardFolder is not None
+def writeBoardFiles(root, oChibi, boardFolder):
+    if boardFolder is not None and root is not None:
+        folder = getBoardFolder(root, oChibi, boardFolder)
+        with instrument.stage('boardFiles'):
+            try:
+                chibi.generateBoardFiles(root, folder)
+            except (OSError, IOError) as ex:
+                raise cube.CubeError("Failed to save the board files in %s - %s" % (folder, ex))
+            except ValueError as ex:
+                # e.g. a value of the chibi input without a register value
+                raise cube.CubeError("Invalid board %s - %s" % (oChibi, ex))
+
+
+def writeBoard(board, oChibi, boardFolder):
+    if board.cached:
+        print("Writing the cached result in '%s'" % oChibi)
+    else:
+        print("Writing the results in '%s'" % oChibi)
+    with instrument.stage('write'):
+        board.write(oChibi)
+    if boardFolder is not None:
+        writeBoardFiles(board.getRoot(), oChibi, boardFolder)
+
+
+# returns the part number of the converted project
+# with boardFolder ('' - the output_path of the board), board.h / board.c are generated too
+def processIOC(converter, iocText, iCube, iChibi, oChibi, boardFolder=None):
+    board = converter.convertText(iocText, iCube, iChibi)
+    printUnresolved(board.unresolved)
+    writeBoard(board, oChibi, boardFolder)
+    return board.partNumber
+
+
+def printUnresolved(unresolved):
+    for signal in unresolved:
+        print("Unresolved signal %s on %s: %s" % (signal.signal, signal.pin, signal.reason))
+
+
+# the properties of the last conversion of each board are kept in the cache, by
+# the board file; valid as long as the database, the script and the chibi input are the same
+# and the board file is the one written then (any other write of the board invalidates it)
+def getStateName(oChibi):
+    return 'state-' + cache.getKey(os.path.abspath(oChibi))
+
+
+def getStateSignature(converter, iChibi):
+    if iChibi is None:
+        return VERSION, converter.db.getVersion(), None, None
+    return VERSION, converter.db.getVersion(), os.path.abspath(iChibi), cache.fileSignature(iChibi)
+
+
+# updates only the pins (and clocks) changed since the last conversion of the board,
+# the whole board is generated if there is no previous conversion
+def processIncremental(converter, iCube, iChibi, oChibi, boardFolder=None):
+    print("Starting to parse %s" % iCube)
+    if not os.path.isfile(iCube):
+        raise cube.CubeError("File %s doesn't exist" % iCube, -2)
+    instrument.begin()
+    try:
+        with instrument.stage('loadIOC'):
+            with open(iCube) as f:
+                iocText = f.read()
+            project = cube.parseIOC(iocText)
+        partNo = getPartNumber(project)
+        stateName = getStateName(oChibi)
+        signature = getStateSignature(converter, iChibi)
+        state = cache.load(stateName, signature, converter.db.cachePath) if os.path.isfile(oChibi) else None
+
+        updated = False
+        if state is not None and state.get('output') != cache.fileSignature(oChibi):
+            print("'%s' was changed since the last conversion" % oChibi)
+            state = None
+        if state is not None and partNo is not None and state['partNo'] == partNo:
+            previous = cube.IOCProject(state['properties'])
+            pins = previous.getChangedPins(project)
+            clocks = previous.getClocks() != project.getClocks()
+            root = None
+            if not pins and not clocks:
+                print("'%s' is up to date" % oChibi)
+                if boardFolder is not None:
+                    with open(oChibi, 'rb') as f:
+                        root = chibi.parseBoard(f.read())
+                updated = True
+            else:
+                mcu = converter.getMCU(partNo)
+                mcu.CubeFile = iCube
+                with instrument.stage('updateProperties'):
+                    mcu.updateProperties(project)
+                printUnresolved(mcu.unresolved)
+                with instrument.stage('patchConfig'):
+                    root = chibi.patchConfig(mcu, pins, clocks, iChibi, oChibi)
+                updated = root is not None
+            if updated:
+                writeBoardFiles(root, oChibi, boardFolder)
+
+        if not updated:
+            partNo = processIOC(converter, iocText, iCube, iChibi, oChibi, boardFolder)
+        cache.store(stateName, signature, {'partNo': partNo, 'properties': project.properties,
+                                           'output': cache.fileSignature(oChibi)}, converter.db.cachePath)
+        return partNo
+    finally:
+        if instrument.ENABLED:
+            PROFILES.append(instrument.end(iCube))
+
+
+# all .ioc files from the folders / glob patterns, with the output file of each one
+def findProjects(patterns, outFolder):
+    import glob
+    projects = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, subFolders, files in os.walk(pattern):
+                for fileName in sorted(files):
+                    if fileName.endswith('.ioc'):
+                        relName = os.path.relpath(os.path.join(root, fileName), pattern)
+                        projects.append((os.path.join(root, fileName),
+                                         os.path.join(outFolder, relName[:-4] + ".chcfg")))
+        else:
+            # the structure below the folder of the pattern is kept, as for the folders
+            base = os.path.dirname(pattern)
+            while glob.has_magic(base):
+                base = os.path.dirname(base)
+            for fileName in sorted(glob.glob(pattern, recursive=True)):
+                if fileName.endswith('.ioc'):
+                    relName = os.path.relpath(fileName, base or os.curdir)
+                    projects.append((fileName, os.path.join(outFolder, relName[:-4] + ".chcfg")))
+    # a project found again is converted once; two projects with the same output (e.g. the
+    # same name from two patterns) fail, one of the results would be lost
+    outputs = {}
+    for iCube, oChibi in projects:
+        other = outputs.setdefault(os.path.normpath(oChibi), iCube)
+        if os.path.abspath(other) != os.path.abspath(iCube):
+            raise cube.CubeError("%s and %s are both converted to %s" % (other, iCube, oChibi), -5)
+    return [(iCube, oChibi) for oChibi, iCube in outputs.items()]
+
+
+_converter = None  # the converter of a batch worker
+
+
+def _initBatch_(cubePath, cachePath, useResults, xml, profile):
+    global _converter
+    _converter = Converter(cubePath, cachePath, useResults, xml)
+    if profile:
+        instrument.enable()
+
+
+# in batch / export mode the board files of <name>.chcfg are written in the <name> folder
+def getBatchBoardFolder(oChibi, boardFiles):
+    return os.path.splitext(oChibi)[0] if boardFiles else None
+
+
+def _processBatch_(job):
+    iChibi, projects, boardFiles = job
+    results = []
+    for iCube, oChibi in projects:
         try:
-            partNo = properties[key]
-            break
-        except KeyError as ex:
-            pass
-    print(partNo)
+            outFolder = os.path.dirname(oChibi)
+            if outFolder and not os.path.isdir(outFolder):
+                os.makedirs(outFolder)
+            ok = processFile(_converter, iCube, iChibi, oChibi, getBatchBoardFolder(oChibi, boardFiles)) is not None
+        except Exception as ex:
+            print("Failed to convert %s - %s" % (iCube, ex))
+            ok = False
+        results.append((iCube, oChibi, ok, PROFILES.pop() if PROFILES else None))
+    return results
+
+
+# runs the batches in a pool of workers, returns the results of all the batches
+def runBatches(converter, func, batches, jobs):
+    import multiprocessing
+    # the families index is built once, the workers load it from the cache
+    converter.db.loadFamiliesIndex()
+    pool = multiprocessing.Pool(jobs, _initBatch_, (converter.db.path, converter.db.cachePath, converter.useResults,
+                                                    converter.db.xml.name, instrument.ENABLED))
+    try:
+        results = []
+        for batch in pool.imap_unordered(func, batches):
+            results += batch
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+# the items of each group are kept together (same worker), big groups are still split between all the workers
+def splitGroups(groups, jobs):
+    batches = []
+    for name in sorted(groups, key=str):
+        group = groups[name]
+        size = max(1, -(-len(group) // jobs))
+        for i in range(0, len(group), size):
+            batches.append(group[i:i + size])
+    return batches
+
+
+def reportBatch(results, what):
+    PROFILES.extend(profile for name, output, ok, profile in results if profile is not None)
+    failed = [name for name, output, ok, profile in results if not ok]
+    print("Converted %d of %d %s" % (len(results) - len(failed), len(results), what))
+    for name in sorted(failed):
+        print("Failed: %s" % name)
+    return len(failed) == 0
+
+
+def processBatch(converter, patterns, iChibi, outFolder, jobs=None, boardFiles=False):
+    import multiprocessing
+    projects = findProjects(patterns, outFolder)
+    print("Found %d files" % len(projects))
+    jobs = jobs or multiprocessing.cpu_count()
+
+    # the projects of the same part number are sent together, so the worker
+    # loads the MCU once; big groups are still split between all the workers
+    byPart = {}
+    for iCube, oChibi in projects:
+        try:
+            partNo = getPartNumber(cube.loadIOC(iCube))
+        except (OSError, IOError, ValueError):
+            partNo = None  # the project fails in its worker, reported as the other failures
+        byPart.setdefault(partNo, []).append((iCube, oChibi))
+    batches = [(iChibi, group, boardFiles) for group in splitGroups(byPart, jobs)]
+    return reportBatch(runBatches(converter, _processBatch_, batches, jobs), 'files')
+
+
+def _readProject_(project, iChibi, converter):
+    iCube, oChibi = project
+    if not os.path.isfile(iCube):
+        raise cube.CubeError("File %s doesn't exist" % iCube, -2)
+    with open(iCube) as f:
+        iocText = f.read()
+    # the MCU is loaded (and cached, for the worker processes) before the project is converted,
+    # unless the result is cached
+    if converter.useResults:
+        key = converter.getResultKey(iocText, iCube, iChibi)
+        if cache.hasResult(key, converter.db.cachePath):
+            return iocText
+    partNo = getPartNumber(cube.parseIOC(iocText))
     if partNo is not None:
-        mcu = cube.getMCU(partNo)
-        if mcu:
-            mcu.CubeFile = iCube
-            mcu.updateProperties(properties)
-            chibi.generateConfig(mcu, iChibi, oChibi)
+        converter.db.prefetchMCU(partNo)
+    return iocText
+
+
+# the conversion of a project read by the pipeline: in a worker process or, with the
+# converter given, in a thread; returns (board, profile)
+def _convertProject_(project, iocText, iChibi, converter=None):
+    iCube, oChibi = project
+    instrument.begin()
+    try:
+        board = (converter or _converter).convertText(iocText, iCube, iChibi)
+    finally:
+        profile = instrument.end(iCube) if instrument.ENABLED else None
+    if converter is None:
+        # the xml tree is not sent back by the worker, it is parsed again if the board files are needed
+        board.root = None
+    return board, profile
+
+
+def _writeProject_(project, result, boardFiles):
+    iCube, oChibi = project
+    board, profile = result
+    outFolder = os.path.dirname(oChibi)
+    if outFolder and not os.path.isdir(outFolder):
+        os.makedirs(outFolder, exist_ok=True)
+    printUnresolved(board.unresolved)
+    writeBoard(board, oChibi, getBatchBoardFolder(oChibi, boardFiles))
+
+
+# the batch conversion as a pipeline: the projects are read ahead and written behind
+# while they are converted, in jobs processes (in a thread for one job)
+def processPipeline(converter, patterns, iChibi, outFolder, jobs=None, boardFiles=False):
+    import concurrent.futures
+    import multiprocessing
+    import pipeline  # asyncio, only for this mode
+    projects = findProjects(patterns, outFolder)
+    print("Found %d files" % len(projects))
+    jobs = jobs or multiprocessing.cpu_count()
+    results = []
+
+    def done(project, result, error):
+        iCube, oChibi = project
+        results.append((iCube, oChibi, error is None, result[1] if result is not None else None))
+        if error is not None:
+            print("Failed to convert %s - %s" % (iCube, error))
         else:
-            print("Failed to load %s" % partNo)
+            print("Converted %s -> %s (%d of %d)" % (iCube, oChibi, len(results), len(projects)))
+
+    converter.db.loadFamiliesIndex()
+    if jobs == 1:
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        convert = functools.partial(_convertProject_, iChibi=iChibi, converter=converter)
+    else:
+        # the MCUs are loaded by threads meanwhile: the workers are started, not forked
+        executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, multiprocessing.get_context('spawn'), _initBatch_,
+            (converter.db.path, converter.db.cachePath, converter.useResults, converter.db.xml.name,
+             instrument.ENABLED))
+        convert = functools.partial(_convertProject_, iChibi=iChibi)
+    with executor:
+        read = functools.partial(_readProject_, iChibi=iChibi, converter=converter)
+        write = functools.partial(_writeProject_, boardFiles=boardFiles)
+        pipeline.run(projects, read, convert, write, done, executor, jobs)
+    return reportBatch(results, 'files')
+
+
+def exportMCU(converter, partNo, iChibi, oChibi, boardFolder=None):
+    writeBoard(converter.exportMCU(partNo, iChibi), oChibi, boardFolder)
+    return partNo
+
+
+def _exportBatch_(job):
+    iChibi, parts, boardFiles = job
+    results = []
+    for partNo, oChibi in parts:
+        instrument.begin()
+        try:
+            outFolder = os.path.dirname(oChibi)
+            if outFolder and not os.path.isdir(outFolder):
+                os.makedirs(outFolder, exist_ok=True)
+            ok = exportMCU(_converter, partNo, iChibi, oChibi, getBatchBoardFolder(oChibi, boardFiles)) is not None
+        except Exception as ex:
+            print("Failed to export %s - %s" % (partNo, ex))
+            ok = False
+        results.append((partNo, oChibi, ok, instrument.end(partNo) if instrument.ENABLED else None))
+    return results
+
+
+# the default .chcfg of all the MCUs from families.xml (optionally filtered), in <output>/<family>/<RefName>.chcfg
+def processExport(converter, patterns, family, iChibi, outFolder, jobs=None, boardFiles=False):
+    import multiprocessing
+    mcus = converter.db.findMCUs(family, patterns)
+    print("Found %d MCUs" % len(mcus))
+    jobs = jobs or multiprocessing.cpu_count()
+
+    # the MCUs of a family are exported together - most of them share the same GPIO IP,
+    # loaded once per worker
+    byFamily = {}
+    for partNo, mcuFamily in mcus:
+        oChibi = os.path.join(outFolder, mcuFamily or 'unknown', partNo + '.chcfg')
+        byFamily.setdefault(mcuFamily, []).append((partNo, oChibi))
+    batches = [(iChibi, group, boardFiles) for group in splitGroups(byFamily, jobs)]
+    return reportBatch(runBatches(converter, _exportBatch_, batches, jobs), 'MCUs') and len(mcus) > 0
+
+
+# converts the projects again when they (or the chibi input) are changed; the
+# database, the MCU models and the GPIO descriptions loaded stay in memory
+def watchProjects(converter, iocFiles, iChibi, output, incremental=False, boardFolder=None):
+    import watch
+    if len(iocFiles) == 1:
+        projects = [(iocFiles[0], output or 'board.chcfg', boardFolder)]
     else:
-        print("Failed to identify the part number in the specified file %s"
-              % iCube)
-    return mcu
+        projects = []
+        for iCube in iocFiles:
+            oChibi = os.path.join(output or 'out', os.path.splitext(os.path.basename(iCube))[0] + ".chcfg")
+            projects.append((iCube, oChibi, getBatchBoardFolder(oChibi, boardFolder is not None)))
+    convert = processIncremental if incremental else processFile
+
+    def update(changed):
+        changed = set(changed)
+        chibiChanged = iChibi is not None and os.path.abspath(iChibi) in changed
+        for iCube, oChibi, board in projects:
+            if chibiChanged or os.path.abspath(iCube) in changed:
+                try:
+                    outFolder = os.path.dirname(oChibi)
+                    if outFolder and not os.path.isdir(outFolder):
+                        os.makedirs(outFolder, exist_ok=True)
+                    convert(converter, iCube, iChibi, oChibi, board)
+                except Exception as ex:
+                    print("Failed to convert %s - %s" % (iCube, ex))
+
+    fileNames = [iCube for iCube in iocFiles] + ([iChibi] if iChibi is not None else [])
+    converter.db.loadFamiliesIndex()
+    update([os.path.abspath(iCube) for iCube in iocFiles])
+    print("Watching %s" % ", ".join(fileNames))
+    try:
+        watch.watchFiles(fileNames, update)
+    except KeyboardInterrupt:
+        pass
+
+
+def writeProfile(fileName):
+    report = {'files': PROFILES, 'summary': instrument.summarize(PROFILES)}
+    with open(fileName, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("The profile report was written in '%s'" % fileName)
+
+
+# a request is a JSON object:
+#   {"id": <optional>, "ioc": <.ioc file>, "iocText": <.ioc content, instead of "ioc">,
+#    "chibi": <optional .chcfg input>, "output": <.chcfg output>, "board": <optional board.h / board.c folder>}
+def serveRequest(converter, request):
+    response = {'id': request.get('id'), 'ok': False}
+    try:
+        oChibi = request['output']
+        iChibi = request.get('chibi')
+        if 'iocText' in request:
+            iCube = request.get('ioc', '<iocText>')
+            partNo = processIOC(converter, request['iocText'], iCube, iChibi, oChibi, request.get('board'))
+        else:
+            partNo = processFile(converter, request['ioc'], iChibi, oChibi, request.get('board'))
+        response.update(ok=True, output=oChibi, partNumber=partNo)
+    except KeyError as ex:
+        response['error'] = "Missing field %s" % ex
+    except Exception as ex:
+        response['error'] = "Failed to convert - %s" % ex
+    return response
+
+
+def serveLine(converter, line):
+    try:
+        request = json.loads(line)
+    except ValueError as ex:
+        return {'ok': False, 'error': "Invalid request - %s" % ex}
+    if not isinstance(request, dict):
+        return {'ok': False, 'error': "Invalid request - a JSON object is expected"}
+    return serveRequest(converter, request)
+
+
+# serve newline-delimited JSON requests from stdin or an unix socket,
+# with the CubeMX database loaded once
+def serve(converter, socketPath=None):
+    if socketPath is None:
+        # stdout is used for the responses, all the messages go to stderr
+        responses = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            converter.db.loadFamiliesIndex()
+            for line in sys.stdin:
+                if line.strip():
+                    responses.write(json.dumps(serveLine(converter, line)) + '\n')
+                    responses.flush()
+        return
+
+    import socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    response = serveLine(self.server.converter, line.decode('utf-8'))
+                    self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+
+    converter.db.loadFamiliesIndex()
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = socketserver.UnixStreamServer(socketPath, RequestHandler)
+    server.converter = converter
+    # stopped with SIGTERM - still remove the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Listening on %s" % socketPath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socketPath)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Parsing a STM32CubeMX project file")
-    parser.add_argument("--ioc", required=True, help="The file to convert")
-    parser.add_argument("--cube", required=True, help="The STM32CubeMX installation folder")
-    parser.add_argument("--output", required=False, default='board.chcfg', help="The .chcfg file output")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--ioc", help="The file to convert")
+    group.add_argument("--batch", nargs='+', metavar='PATH',
+                       help="Folders / glob patterns of the .ioc files to convert")
+    group.add_argument("--export", nargs='*', metavar='PATTERN',
+                       help="Generate the default .chcfg of the MCUs from the database, "
+                            "optionally only of the RefName patterns (e.g. STM32F407*)")
+    group.add_argument("--watch", nargs='+', metavar='IOC',
+                       help="Convert the .ioc files again each time they are changed")
+    group.add_argument("--serve", action='store_true',
+                       help="Serve JSON conversion requests, one per line, from stdin or --socket")
+    parser.add_argument("--cube", required=True, help="The STM32CubeMX installation folder, or a zip / tar archive of it")
+    parser.add_argument("--output", required=False, default=None,
+                        help="The .chcfg file output (default board.chcfg) / the output folder in batch, export "
+                             "and watch mode with more files (default out)")
     parser.add_argument("--chibi", required=False, default=None, help="The .chcfg file input")
+    parser.add_argument("--cache", required=False, default=None,
+                        help="The folder where the data extracted from STM32CubeMX is cached")
+    parser.add_argument("--no-results-cache", action='store_true',
+                        help="Always convert, without using / updating the cached results")
+    parser.add_argument("--clear-results-cache", action='store_true',
+                        help="Remove all the cached results before starting")
+    parser.add_argument("--profile", required=False, default=None, metavar='REPORT',
+                        help="Measure each stage of the conversions and write the JSON report in this file")
+    parser.add_argument("--version", action='version', version='%(prog)s ' + VERSION)
+    parser.add_argument("--jobs", required=False, default=None, type=int,
+                        help="The number of parallel conversions in batch mode (default: the number of cores)")
+    parser.add_argument("--socket", required=False, default=None,
+                        help="The unix socket used by --serve, instead of stdin / stdout")
+    parser.add_argument("--board", nargs='?', const='', default=None, metavar='FOLDER',
+                        help="Generate board.h / board.c too, in this folder (default: the output_path of the "
+                             "board; in batch and export mode, a folder with the name of each .chcfg)")
+    parser.add_argument("--incremental", action='store_true',
+                        help="Update only the pins changed since the last conversion of the output .chcfg "
+                             "(also in watch mode)")
+    parser.add_argument("--family", required=False, default=None,
+                        help="Export only the MCUs of this family (e.g. STM32F4)")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="In batch mode, read the files ahead and write them behind while converting "
+                             "(in --jobs processes, in a thread with --jobs 1); each file is reported when done")
+    parser.add_argument("--xml", required=False, default=None, choices=sorted(xmlbackend.BACKENDS),
+                        help="The xml parser used for the STM32CubeMX database (default: %s)"
+                             % xmlbackend.DEFAULT.name)
     args = parser.parse_args()
-    # cube.args = args
-    CUBE_PATH = cube.CUBE_PATH = args.cube
-    iocFile = args.ioc
-
-    processFile(iocFile, args.chibi, args.output)
-
-    # counter = 0
-    # for root, subFolders, files in os.walk(CUBE_PATH):
-    #     for file in files:
-    #         if file.endswith('.ioc'):
-    #             counter += 1
-    #             fileName = os.path.join(root, file)
-    #             processFile(fileName, None, "out/" + file[:-4] + ".chcfg")
-    #             print file
-    #
-    # print("Found %d files" % counter)
+    if args.clear_results_cache:
+        cache.clearResults(args.cache)
+    if args.profile:
+        instrument.enable()
 
+    try:
+        converter = Converter(args.cube, args.cache, not args.no_results_cache, args.xml)
+        if args.serve:
+            serve(converter, args.socket)
+        elif args.watch:
+            # stopped with SIGTERM - still write the profile
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            watchProjects(converter, args.watch, args.chibi, args.output, args.incremental, args.board)
+        elif args.export is not None:
+            if not processExport(converter, args.export, args.family, args.chibi, args.output or 'out', args.jobs,
+                                 args.board is not None):
+                sys.exit(-5)
+        elif args.batch:
+            process = processPipeline if args.pipeline else processBatch
+            if not process(converter, args.batch, args.chibi, args.output or 'out', args.jobs, args.board is not None):
+                sys.exit(-5)
+        elif args.incremental:
+            processIncremental(converter, args.ioc, args.chibi, args.output or 'board.chcfg', args.board)
+        else:
+            processFile(converter, args.ioc, args.chibi, args.output or 'board.chcfg', args.board)
+    except cube.CubeError as ex:
+        print(ex)
+        sys.exit(ex.exitCode)
+    finally:
+        if args.profile:
+            writeProfile(args.profile)
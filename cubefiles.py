@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# Copyright (C) Cezar Burlacu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    The files of the CubeMX database: from the STM32CubeMX installation folder or from
+    a zip / tar(.gz) archive of it (only the db folder is needed). The paths are relative
+    to the installation folder, e.g. /db/mcu/families.xml
+"""
+
+import os
+import mmap
+import struct
+import threading
+import cache
+
+FAMILIES_MEMBER = 'db/mcu/families.xml'  # used to find the installation folder in an archive
+
+
+class Folder:
+    """
+        The STM32CubeMX installation folder - the files are given by name to the parsers
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def getName(self, relPath):
+        return os.path.abspath(self.path + relPath)
+
+    def getSignature(self, relPath):
+        return cache.fileSignature(self.path + relPath)
+
+    def open(self, relPath):
+        return self.path + relPath
+
+
+class _Member:
+    """
+        A file of an archive, read from the archive when the parser asks for it first:
+        a missing file fails as a missing file of a folder (IOError) while parsing
+    """
+
+    def __init__(self, archive, member):
+        self.archive = archive
+        self.member = member
+        self.name = archive.path + '/' + member
+        self._data = None
+        self._pos = 0
+        self._end = 0
+
+    def read(self, size=-1):
+        if self._data is None:
+            self._data, self._pos, self._end = self.archive.readMember(self.member)
+        end = self._end if size is None or size < 0 else min(self._pos + size, self._end)
+        # the data is a memory map or the decompressed member
+        chunk = self._data[self._pos:end]
+        self._pos = end
+        return chunk
+
+
+class _Archive:
+    """
+        The index of the members is built once; the uncompressed members are read
+        straight from a memory map of the archive, the others are decompressed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = cache.fileSignature(path)
+        self.prefix = ''
+        self.members = {}
+        self.lock = threading.Lock()
+        self.map = None
+
+    # the members are indexed by the path relative to the installation folder
+    def index(self, members):
+        names = [name for name in members if name.endswith(FAMILIES_MEMBER)]
+        if names:
+            self.prefix = min(names, key=len)[:-len(FAMILIES_MEMBER)]
+        for name, member in members.items():
+            if name.startswith(self.prefix):
+                self.members[name[len(self.prefix):]] = member
+
+    def mapArchive(self):
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def getMember(self, relPath):
+        return relPath.lstrip('/')
+
+    def getName(self, relPath):
+        return os.path.abspath(self.path) + '/' + self.prefix + self.getMember(relPath)
+
+    def getSignature(self, relPath):
+        member = self.members.get(self.getMember(relPath))
+        if member is None or self.signature is None:
+            return None
+        return self.signature + self.getMemberSignature(member)
+
+    def open(self, relPath):
+        return _Member(self, self.getMember(relPath))
+
+    # (data, start, end) of a member
+    def readMember(self, name):
+        member = self.members.get(name)
+        if member is None:
+            raise IOError("No such file in the archive: '%s%s'" % (self.prefix, name))
+        return self.readData(member)
+
+
+class ZipArchive(_Archive):
+    def __init__(self, path):
+        import zipfile
+        _Archive.__init__(self, path)
+        self.stored = zipfile.ZIP_STORED
+        self.zip = zipfile.ZipFile(path)
+        self.index(dict((info.filename, info) for info in self.zip.infolist() if not info.is_dir()))
+        if any(info.compress_type == self.stored for info in self.members.values()):
+            self.mapArchive()
+
+    def getMemberSignature(self, info):
+        return info.file_size, info.CRC
+
+    def readData(self, info):
+        if info.compress_type == self.stored and not info.flag_bits & 0x1:
+            # the data follows the local header: 30 bytes, the file name and the extra field
+            offset = info.header_offset
+            nameSize, extraSize = struct.unpack('<HH', self.map[offset + 26:offset + 30])
+            start = offset + 30 + nameSize + extraSize
+            return self.map, start, start + info.file_size
+        with self.lock:
+            data = self.zip.read(info)
+        return data, 0, len(data)
+
+
+class TarArchive(_Archive):
+    def __init__(self, path):
+        import tarfile
+        _Archive.__init__(self, path)
+        try:
+            self.tar = tarfile.open(path, 'r:')
+            compressed = False
+        except tarfile.ReadError:
+            # the members of a compressed archive are decompressed when needed
+            self.tar = tarfile.open(path, 'r:*')
+            compressed = True
+        self.index(dict((info.name, info) for info in self.tar.getmembers() if info.isfile()))
+        if not compressed:
+            self.mapArchive()
+
+    def getMemberSignature(self, info):
+        return info.size, info.mtime
+
+    def readData(self, info):
+        if self.map is not None and not info.issparse():
+            return self.map, info.offset_data, info.offset_data + info.size
+        with self.lock:
+            data = self.tar.extractfile(info).read()
+        return data, 0, len(data)
+
+
+# the files of the database at path: a folder or an archive; None if there is none.
+# A damaged archive raises IOError
+def openFiles(path):
+    if path is None:
+        return None
+    if os.path.isdir(path):
+        return Folder(path)
+    if not os.path.isfile(path):
+        return None
+    # the archive modules are imported only when the database is an archive
+    import tarfile
+    import zipfile
+    try:
+        if zipfile.is_zipfile(path):
+            return ZipArchive(path)
+        if tarfile.is_tarfile(path):
+            return TarArchive(path)
+    except (zipfile.BadZipfile, tarfile.TarError, EOFError) as ex:
+        raise IOError(ex)
+    return None
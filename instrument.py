@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Copyright (C) Cezar Burlacu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Per stage measurements of a conversion: wall time, visited xml elements and peak
+    memory (the peak of the memory allocated by python during the stage, tracemalloc).
+    The stages are measured per thread, the memory is measured for the whole process
+"""
+
+import time
+import threading
+import tracemalloc
+
+ENABLED = False
+
+_local = threading.local()
+
+
+# the running stages, stage name -> measurements for the current file and the visited elements
+def _state():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+        _local.stages = {}
+        _local.visited = 0
+    return _local
+
+
+class _Stage_:
+    """
+        A measured stage - the nested stages are named <parent>.<stage>
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        state = _state()
+        if state.stack:
+            # the peak of the parent so far, the peak is reset for this stage
+            state.stack[-1].peak = max(state.stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            self.name = state.stack[-1].name + '.' + self.name
+        tracemalloc.reset_peak()
+        self.peak = 0
+        self.visited = state.visited
+        self.start = time.perf_counter()
+        state.stack.append(self)
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        elapsed = time.perf_counter() - self.start
+        state = _state()
+        state.stack.pop()
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        if state.stack:
+            state.stack[-1].peak = max(state.stack[-1].peak, self.peak)
+        stage = state.stages.setdefault(self.name, {'calls': 0, 'time': 0.0, 'elements': 0, 'peakMemory': 0})
+        stage['calls'] += 1
+        stage['time'] += elapsed
+        stage['elements'] += state.visited - self.visited
+        stage['peakMemory'] = max(stage['peakMemory'], self.peak)
+        return False
+
+
+class _NoStage_:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+
+_noStage = _NoStage_()
+
+
+def stage(name):
+    return _Stage_(name) if ENABLED else _noStage
+
+
+def visit(count=1):
+    if ENABLED:
+        _state().visited += count
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def begin():
+    state = _state()
+    state.stages.clear()
+    del state.stack[:]
+
+
+# the measurements of the file converted since begin() by this thread
+def end(fileName):
+    state = _state()
+    report = {'file': fileName, 'stages': dict(state.stages)}
+    state.stages.clear()
+    return report
+
+
+def summarize(reports):
+    summary = {}
+    for report in reports:
+        for name, stage in report['stages'].items():
+            total = summary.setdefault(name, {'files': 0, 'calls': 0, 'time': 0.0, 'maxTime': 0.0,
+                                              'elements': 0, 'peakMemory': 0})
+            total['files'] += 1
+            total['calls'] += stage['calls']
+            total['time'] += stage['time']
+            total['maxTime'] = max(total['maxTime'], stage['time'])
+            total['elements'] += stage['elements']
+            total['peakMemory'] = max(total['peakMemory'], stage['peakMemory'])
+    for total in summary.values():
+        total['meanTime'] = total['time'] / total['files']
+    return summary
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Copyright (C) Cezar Burlacu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    An asyncio pipeline: the items are read ahead, converted by an executor and written
+    behind. The queues between the stages are bounded, so the memory used doesn't grow
+    with the number of items
+"""
+
+import asyncio
+import concurrent.futures
+
+QUEUE_SIZE = 16  # the items read ahead / waiting to be written
+
+
+class _Failed_:
+    """
+        An item failed in a stage - the next stages only pass it on
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+async def _read_(loop, io, items, read, inputs, converters):
+    for item in items:
+        try:
+            data = await loop.run_in_executor(io, read, item)
+        except Exception as ex:
+            data = _Failed_(ex)
+        await inputs.put((item, data))
+    for i in range(converters):
+        await inputs.put(None)
+
+
+async def _convert_(loop, executor, convert, inputs, outputs):
+    while True:
+        entry = await inputs.get()
+        if entry is None:
+            break
+        item, data = entry
+        if not isinstance(data, _Failed_):
+            try:
+                data = await loop.run_in_executor(executor, convert, item, data)
+            except Exception as ex:
+                data = _Failed_(ex)
+        await outputs.put((item, data))
+
+
+async def _write_(loop, io, write, done, outputs):
+    while True:
+        entry = await outputs.get()
+        if entry is None:
+            break
+        item, result = entry
+        error = result.error if isinstance(result, _Failed_) else None
+        if error is None:
+            try:
+                await loop.run_in_executor(io, write, item, result)
+            except Exception as ex:
+                error = ex
+        done(item, None if error is not None else result, error)
+
+
+async def _run_(items, read, convert, write, done, executor, converters):
+    loop = asyncio.get_running_loop()
+    inputs = asyncio.Queue(QUEUE_SIZE)
+    outputs = asyncio.Queue(QUEUE_SIZE)
+    # one thread reads, one writes - in order, the messages of the items are not mixed
+    with concurrent.futures.ThreadPoolExecutor(1) as reader, concurrent.futures.ThreadPoolExecutor(1) as writer:
+        written = asyncio.ensure_future(_write_(loop, writer, write, done, outputs))
+        await asyncio.gather(_read_(loop, reader, items, read, inputs, converters),
+                             *[_convert_(loop, executor, convert, inputs, outputs) for i in range(converters)])
+        await outputs.put(None)
+        await written
+
+
+def run(items, read, convert, write, done, executor, converters=1):
+    """
+        read(item) and write(item, result) run in threads, convert(item, data) in the executor
+        (up to converters items at once); done(item, result, error) is called for each item as
+        soon as it is written or it failed, error is the exception of the stage that failed
+    """
+    asyncio.run(_run_(list(items), read, convert, write, done, executor, converters))
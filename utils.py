@@ -18,10 +18,16 @@
     Misc
 """
 
-import lxml.etree as et
 import re
+import threading
+import instrument
+import xmlbackend
+from collections import OrderedDict
+
+et = xmlbackend.lxml  # lxml.etree, imported when used first - for the boards
 
 PORT_REGEX = "^P([A-K])([0-9]{1,2})"
+PORTS = "ABCDEFGHIJK"
 MAX_PINS_PER_PORT = 16
 
 
@@ -47,22 +53,73 @@ def getPinName(port, pinNo):
     return "{0}{1}".format(port, pinNo)
 
 
-def getRoot(fileName, parser=None):
+# the root element of a xml file (a file name or a named file object), with the xml
+# backend given (default: the one for the CubeMX database); if the file is required,
+# a read error is raised instead of returning an empty element
+def getRoot(fileName, backend=None, required=False):
+    backend = backend or xmlbackend.DEFAULT
+    name = getattr(fileName, 'name', fileName)
+    try:
+        print("Loading %s" % name)
+        root = backend.parse(fileName)
+        if instrument.ENABLED:
+            instrument.visit(sum(1 for elem in root.iter()))
+        return root, getNs(root.tag)
+    except (OSError, IOError) as ex:
+        if required:
+            raise
+        print("Failed to load %s - %s\n"
+              "Is the path right - %s - ?" % (name, ex, name))
+        return backend.createElement('empty'), ''
+
+
+def getNs(tag):
+    m = re.match('\{.*\}', tag)
+    return m.group(0) if m else ''
+
+
+def iterElems(fileName, tags, backend=None, required=False):
+    """
+        Stream the elements with the given tags (without namespace) from an xml file.
+        Each element is yielded when complete, with the namespace of the document and
+        its ancestors (root first, only the attributes are available), and it is cleared
+        after it was used - don't keep references to it. The parsing stops as soon as the
+        caller stops iterating. If the file is required, a read error is raised.
+    """
+    backend = backend or xmlbackend.DEFAULT
+    name = getattr(fileName, 'name', fileName)
+    print("Loading %s" % name)
+    ns = None
+    parents = []
     try:
-        print("Loading %s" % fileName)
-        root = et.parse(fileName, parser).getroot()
-        m = re.match('\{.*\}', root.tag)
-        return root, m.group(0) if m else ''
+        for event, elem in backend.iterparse(fileName):
+            if ns is None:
+                ns = getNs(elem.tag)
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            instrument.visit()
+            if elem.tag[len(ns):] not in tags:
+                continue
+            yield elem, ns, parents
+            # drop what was already processed - the element is the last child of its parent
+            elem.clear()
+            if parents:
+                del parents[-1][:]
     except (OSError, IOError) as ex:
+        if required:
+            raise
         print("Failed to load %s - %s\n"
-              "Is the path right - %s - ?" % (fileName, ex, fileName))
-        return et.Element('empty'), ''
+              "Is the path right - %s - ?" % (name, ex, name))
 
 
 def getElems(parent, xpath, ns):
     xpath = xpath.format(ns)
     xpathExpr = ".//%s%s" % (ns, xpath)
-    return parent.findall(xpathExpr)
+    elems = parent.findall(xpathExpr)
+    instrument.visit(len(elems))
+    return elems
 
 
 def getElem(parent, xpath, ns):
@@ -90,6 +147,35 @@ def getOrCreateElem(parent, xpath, tag, ns):
     return elem
 
 
+class LruCache(OrderedDict):
+    """
+        A dictionary keeping only the last maxSize used items; get / set can be used from more threads
+    """
+
+    def __init__(self, maxSize):
+        OrderedDict.__init__(self)
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return OrderedDict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            OrderedDict.__setitem__(self, key, value)
+            self.move_to_end(key)
+            while len(self) > self.maxSize:
+                self.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            OrderedDict.clear(self)
+
+
 def isEmpty(s):
     return not bool(s and s.strip())
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# Copyright (C) Cezar Burlacu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Waiting for the changes of some files: inotify (linux), polling if it is not available
+"""
+
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import cache
+
+POLL_INTERVAL = 1.0
+# the changes are reported once the files are not changed for this time (seconds)
+DEBOUNCE = 0.5
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_eventHeader = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+
+class InotifyWatcher:
+    """
+        The folders of the files are watched: the editors (CubeMX too) usually
+        write a new file and rename it over the old one
+    """
+
+    def __init__(self, fileNames):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.files = set(os.path.abspath(fileName) for fileName in fileNames)
+        self.folders = {}
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        for folder in sorted(set(os.path.dirname(fileName) for fileName in self.files)):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder),
+                                             IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+            if wd < 0:
+                error = ctypes.get_errno()
+                self.close()
+                raise OSError(error, "%s - %s" % (os.strerror(error), folder))
+            self.folders[wd] = folder
+
+    # the watched files changed until a change / timeout (None - wait for a change)
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            if not select.select([self.fd], [], [], remaining)[0]:
+                break
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset + _eventHeader.size <= len(data):
+                wd, mask, cookie, length = _eventHeader.unpack_from(data, offset)
+                offset += _eventHeader.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                fileName = os.path.join(self.folders.get(wd, ''), name)
+                if fileName in self.files:
+                    changed.add(fileName)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    def __init__(self, fileNames, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.files = dict((os.path.abspath(fileName), cache.fileSignature(fileName)) for fileName in fileNames)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            time.sleep(self.interval if remaining is None else min(self.interval, remaining))
+            for fileName, signature in self.files.items():
+                newSignature = cache.fileSignature(fileName)
+                if newSignature != signature:
+                    self.files[fileName] = newSignature
+                    changed.add(fileName)
+        return changed
+
+    def close(self):
+        pass
+
+
+def createWatcher(fileNames):
+    try:
+        return InotifyWatcher(fileNames)
+    except (OSError, AttributeError) as ex:
+        print("inotify is not available (%s), the files are polled" % ex)
+        return PollingWatcher(fileNames)
+
+
+# calls callback(changed files) for each change, once the files are not changed for debounce
+# seconds - CubeMX writes the project more times when it is saved; runs until interrupted
+def watchFiles(fileNames, callback, debounce=DEBOUNCE):
+    watcher = createWatcher(fileNames)
+    try:
+        while True:
+            changed = watcher.wait()
+            while changed:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            if changed:
+                callback(sorted(changed))
+    finally:
+        watcher.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Copyright (C) Cezar Burlacu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    The xml parsers: the CubeMX database is only read, the standard library parser (expat)
+    is used for it. lxml is needed only for the boards (.chcfg) and it is imported when used first.
+"""
+
+import importlib
+import xml.etree.ElementTree as ElementTree
+
+
+class _LazyModule:
+    """
+        A module imported when one of its attributes is used first
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+lxml = _LazyModule('lxml.etree')
+
+
+class Backend:
+    """
+        An ElementTree like module: the whole file or streamed, the elements
+        have tag (with namespace), attrib, text, find / findall / iter
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def parse(self, fileName):
+        return self.module.parse(fileName).getroot()
+
+    # (event, element) for the start / end of each element
+    def iterparse(self, fileName):
+        return self.module.iterparse(fileName, events=('start', 'end'))
+
+    def createElement(self, tag):
+        return self.module.Element(tag)
+
+
+STDLIB = Backend('stdlib', ElementTree)
+LXML = Backend('lxml', lxml)
+BACKENDS = dict((backend.name, backend) for backend in (STDLIB, LXML))
+
+# for the CubeMX database
+DEFAULT = STDLIB
+
+
+def getBackend(name=None):
+    if name is None:
+        return DEFAULT
+    if name not in BACKENDS:
+        raise ValueError("Unknown xml backend '%s' - one of %s" % (name, ", ".join(sorted(BACKENDS))))
+    return BACKENDS[name]